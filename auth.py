@@ -0,0 +1,241 @@
+import base64
+import collections
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+import uuid
+import database
+
+# How many access tokens to remember, and for how long (in seconds). The cache is per process, so the TTL is also the
+# longest another process's revocation of a token can go unnoticed here.
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 300
+
+# Tokens stop working this many seconds after they were issued, or after they were last used, whichever comes first.
+TOKEN_LIFETIME = 90 * 24 * 60 * 60
+TOKEN_IDLE_TIMEOUT = 14 * 24 * 60 * 60
+
+# When a token was last used is only written back to the database if it's at least this many seconds out of date, so
+# using a token doesn't turn every request into a write.
+TOKEN_TOUCH_INTERVAL = 60 * 60
+
+# Logging in again once a user already has this many tokens revokes their oldest ones.
+MAX_TOKENS_PER_USER = 10
+
+# Expired tokens are deleted this many at a time, every TOKEN_PURGE_INTERVAL seconds.
+TOKEN_PURGE_BATCH_SIZE = 500
+TOKEN_PURGE_INTERVAL = 600
+
+# Signed tokens carry the username and their own expiry under an HMAC, so checking one never touches the database. They
+# can't be revoked individually (logging out just forgets them client side), so they're kept shorter lived; retiring
+# the key they were signed with revokes all of them at once.
+SIGNED_TOKEN_PREFIX = 's1'
+SIGNED_TOKEN_LIFETIME = 7 * 24 * 60 * 60
+
+# Key ID: secret. Tokens are signed with ACTIVE_SIGNING_KEY and accepted if they were signed with any key here, so to
+# rotate, add the new key, make it active, and remove the old one once its tokens have expired. With no active key
+# logins hand out the old database-backed tokens instead. See loadSigningKeys.
+SIGNING_KEYS = {}
+ACTIVE_SIGNING_KEY = None
+
+
+class TokenCache(object):
+    """A thread-safe LRU map of access token to (username, issuedAt, lastUsedAt) whose entries expire after a while."""
+
+    def __init__(self, size=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """Returns what's cached for a token, or None if it isn't cached (or has been for too long)."""
+        with self._lock:
+            entry = self._entries.pop(token, None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= time.time():
+                return None
+            # Put it back at the most recently used end.
+            self._entries[token] = entry
+            return value
+
+    def put(self, token, value):
+        with self._lock:
+            self._entries.pop(token, None)
+            self._entries[token] = (value, time.time() + self.ttl)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token):
+        """Forgets a token, e.g. because it's been revoked or has expired."""
+        with self._lock:
+            self._entries.pop(token, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+tokenCache = TokenCache()
+
+
+def loadSigningKeys(spec):
+    """Sets the signing keys from a string like "2015b:secret,2015a:oldersecret". The first one is used to sign new
+    tokens. An empty string turns signed tokens off."""
+    global ACTIVE_SIGNING_KEY
+    SIGNING_KEYS.clear()
+    ACTIVE_SIGNING_KEY = None
+    for entry in spec.split(','):
+        if not entry.strip():
+            continue
+        keyID, secret = entry.strip().split(':', 1)
+        SIGNING_KEYS[keyID] = secret.encode('utf-8')
+        if ACTIVE_SIGNING_KEY is None:
+            ACTIVE_SIGNING_KEY = keyID
+
+
+loadSigningKeys(os.environ.get('TELEGRAPHIC_SIGNING_KEYS', ''))
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(str(text) + '=' * (-len(text) % 4))
+
+
+def _sign(keyID, payload):
+    return _b64(hmac.new(SIGNING_KEYS[keyID], (SIGNED_TOKEN_PREFIX + '.' + keyID + '.' + payload).encode('utf-8'),
+                         hashlib.sha256).digest())
+
+
+def signToken(username, now=None):
+    """Creates a signed token for a user with the active signing key."""
+    now = int(time.time()) if now is None else now
+    payload = _b64(json.dumps({'u': username, 'iat': now, 'exp': now + SIGNED_TOKEN_LIFETIME}).encode('utf-8'))
+    return '.'.join([SIGNED_TOKEN_PREFIX, ACTIVE_SIGNING_KEY, payload, _sign(ACTIVE_SIGNING_KEY, payload)])
+
+
+def verifySignedToken(token):
+    """Returns the username a signed token was issued to, or None if it's forged, expired, or signed with a key we don't
+    have any more."""
+    parts = token.split('.')
+    if len(parts) != 4 or parts[0] != SIGNED_TOKEN_PREFIX or parts[1] not in SIGNING_KEYS:
+        return None
+    keyID, payload, signature = parts[1:]
+    if not hmac.compare_digest(_sign(keyID, payload).encode('utf-8'), signature.encode('utf-8')):
+        return None
+
+    try:
+        claims = json.loads(_unb64(payload).decode('utf-8'))
+    except ValueError:
+        return None
+    if claims['exp'] <= time.time():
+        return None
+    return claims['u']
+
+
+def _expired(issuedAt, lastUsedAt, now):
+    return issuedAt + TOKEN_LIFETIME <= now or lastUsedAt + TOKEN_IDLE_TIMEOUT <= now
+
+
+def lookupToken(token, con=None):
+    """Returns the username an access token belongs to, or None if it isn't an active token. If the database has to be
+    used, con is used if given, otherwise a connection is checked out just for this."""
+    if token.startswith(SIGNED_TOKEN_PREFIX + '.'):
+        return verifySignedToken(token)
+
+    now = int(time.time())
+    entry = tokenCache.get(token)
+
+    own = False
+    if entry is None or now - entry[2] >= TOKEN_TOUCH_INTERVAL:
+        own = con is None
+        if own:
+            con = database.connect()
+
+    try:
+        if entry is None:
+            c = con.cursor()
+            c.execute("SELECT username, issuedAt, lastUsedAt FROM activeAccessTokens WHERE accessToken=:accessToken",
+                      {'accessToken': token})
+            entry = c.fetchone()
+            if entry is None:
+                return None
+
+        username, issuedAt, lastUsedAt = entry
+        if _expired(issuedAt, lastUsedAt, now):
+            # The purge will get around to deleting it.
+            tokenCache.invalidate(token)
+            return None
+
+        if now - lastUsedAt >= TOKEN_TOUCH_INTERVAL:
+            lastUsedAt = now
+            con.execute("UPDATE activeAccessTokens SET lastUsedAt=:lastUsedAt WHERE accessToken=:accessToken",
+                        {'lastUsedAt': lastUsedAt, 'accessToken': token})
+
+        tokenCache.put(token, (username, issuedAt, lastUsedAt))
+        return username
+    finally:
+        if own:
+            database.close(con)
+
+
+def issueToken(c, username):
+    """Creates a new access token for a user and returns it. That's a signed token if there's an active signing key,
+    otherwise a database-backed one, in which case their oldest ones are revoked if they now have too many."""
+    if ACTIVE_SIGNING_KEY is not None:
+        return signToken(username)
+
+    # XXX: These probably won't collide.
+    token = str(uuid.uuid1())
+    now = int(time.time())
+
+    c.execute(
+        "INSERT INTO activeAccessTokens (accessToken, username, issuedAt, lastUsedAt) VALUES (:accessToken, :username, :now, :now)",
+        {'accessToken': token, 'username': username, 'now': now})
+
+    c.execute(
+        "SELECT accessToken FROM activeAccessTokens WHERE username=:username ORDER BY tokenID DESC LIMIT -1 OFFSET :keep",
+        {'username': username, 'keep': MAX_TOKENS_PER_USER})
+    for r in c.fetchall():
+        revokeToken(c, r[0])
+
+    return token
+
+
+def revokeToken(c, token):
+    """Deletes an access token so it can't be used any more. Returns False, without doing anything, for a signed token,
+    which can't be revoked on its own and keeps working until it expires."""
+    if token.startswith(SIGNED_TOKEN_PREFIX + '.'):
+        return False
+    c.execute("DELETE FROM activeAccessTokens WHERE accessToken=:accessToken", {'accessToken': token})
+    tokenCache.invalidate(token)
+    return True
+
+
+def purgeExpiredTokens(con):
+    """Deletes expired access tokens, a small batch per transaction. Returns how many were deleted."""
+    c = con.cursor()
+    deleted = 0
+    while True:
+        now = int(time.time())
+        c.execute("BEGIN IMMEDIATE")
+        c.execute(
+            "SELECT tokenID, accessToken FROM activeAccessTokens WHERE issuedAt<=:issuedBefore OR lastUsedAt<=:usedBefore LIMIT :batchSize",
+            {'issuedBefore': now - TOKEN_LIFETIME, 'usedBefore': now - TOKEN_IDLE_TIMEOUT,
+             'batchSize': TOKEN_PURGE_BATCH_SIZE})
+        batch = c.fetchall()
+        c.executemany("DELETE FROM activeAccessTokens WHERE tokenID=?", [(r[0],) for r in batch])
+        con.commit()
+        for r in batch:
+            tokenCache.invalidate(r[1])
+        deleted += len(batch)
+        if len(batch) < TOKEN_PURGE_BATCH_SIZE:
+            return deleted
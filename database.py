@@ -1,40 +1,394 @@
+import base64
+import binascii
+import collections
+import shutil
 import sqlite3
+import threading
+import time
+import imagestore
 import queries
 
+DATABASE_FILE = "telegraph.sqlite"
+
+# How many connections the pool will keep open at once, and how long (in seconds) a request will wait for one to be
+# returned before giving up.
+POOL_SIZE = 8
+POOL_TIMEOUT = 10.0
+
+# Per-connection prepared statement cache. Our handlers only use a few dozen distinct statements.
+STATEMENT_CACHE_SIZE = 128
+
+# PRAGMAs applied, in this order, to every connection as it's opened. page_size only sticks on a brand new database (or
+# after a VACUUM), and can't change at all once it's in WAL mode, so it has to come first. Use configureStorage() to
+# override any of these.
+STORAGE_PROFILE = collections.OrderedDict([
+    ('page_size', 4096),
+    # Readers don't block the writer (or vice versa), and a commit only appends to the log instead of syncing the
+    # whole rollback journal.
+    ('journal_mode', 'WAL'),
+    # In WAL mode NORMAL can't corrupt the database; a power cut can only lose the last few commits.
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -16000),  # Negative means KiB, so about 16MB per connection.
+    ('mmap_size', 256 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+    ('busy_timeout', 10000),  # Milliseconds.
+    # Checkpoint automatically once the log reaches this many pages, and trim the log file back down to this many bytes
+    # whenever it's been reset, so a burst of uploads doesn't leave a huge -wal file around.
+    ('wal_autocheckpoint', 1000),
+    ('journal_size_limit', 64 * 1024 * 1024),
+])
+
+# Every this many seconds a background thread checkpoints as much of the log as it can without waiting on anyone. If
+# readers have kept the log from being reset and it's grown past CHECKPOINT_TRUNCATE_PAGES, it then forces a full
+# checkpoint and truncates the log, but only waits CHECKPOINT_BUSY_TIMEOUT milliseconds for them to get out of the way,
+# since writers are held up for as long as it waits.
+CHECKPOINT_INTERVAL = 60
+CHECKPOINT_TRUNCATE_PAGES = 16384
+CHECKPOINT_BUSY_TIMEOUT = 100
+
+# Batched migration steps work through this many rows per transaction, pausing (in seconds) between transactions so the
+# write lock is never held for long while serving requests.
+MIGRATION_BATCH_SIZE = 500
+MIGRATION_BATCH_PAUSE = 0.05
+
+
+def _decodeLegacyImage(text):
+    # Used by migration 4. Anything that won't decode is kept byte for byte rather than failing the whole migration.
+    try:
+        return sqlite3.Binary(base64.b64decode(text))
+    except (binascii.Error, TypeError, ValueError):
+        return sqlite3.Binary(text.encode('utf-8'))
+
+
+def _imageHash(stored, encoding):
+    # Used by migration 5.
+    return imagestore.contentHash(imagestore.unpack(stored, encoding))
+
+
+def _imageSize(stored, encoding):
+    # Used by migration 5.
+    return len(imagestore.unpack(stored, encoding))
+
+
+def _unpackImage(stored, encoding):
+    # Used by migration 11.
+    return sqlite3.Binary(imagestore.unpack(stored, encoding))
+
+
+# Application functions made available to SQL on every connection, as name: (number of arguments, function).
+SQL_FUNCTIONS = {
+    'decodeLegacyImage': (1, _decodeLegacyImage),
+    'imageHash': (2, _imageHash),
+    'imageSize': (2, _imageSize),
+    'unpackImage': (2, _unpackImage),
+}
+
+
+class PoolTimeout(sqlite3.OperationalError):
+    """Raised when no connection could be checked out of the pool in time."""
+    pass
+
+
+class ConnectionPool(object):
+    """A bounded pool of sqlite3 connections that can be shared between the server's threads.
+
+    Connections are handed out most-recently-used first so that the warm ones (with their schema already loaded and
+    their statement caches full) get reused, and the rest are only opened when there's actually concurrent demand."""
+
+    def __init__(self, path, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._opened = 0
+        self._lock = threading.Condition(threading.Lock())
+
+    def _open(self):
+        # check_same_thread is off because a connection may be checked out by a different thread each time, but the
+        # pool makes sure only one thread ever holds it at once.
+        con = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False,
+                              cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma, value in STORAGE_PROFILE.items():
+            con.execute("PRAGMA " + pragma + "=" + str(value)).fetchall()
+        for name, (arguments, function) in SQL_FUNCTIONS.items():
+            con.create_function(name, arguments, function)
+        return con
+
+    def _healthy(self, con):
+        try:
+            con.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _forget(self, con):
+        try:
+            con.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._opened -= 1
+            self._lock.notify()
+
+    def checkout(self):
+        """Takes a connection out of the pool, opening a new one if there's room, or waiting for one to come back."""
+        deadline = time.time() + self.timeout
+        with self._lock:
+            while True:
+                if self._idle:
+                    con = self._idle.pop()
+                    break
+                if self._opened < self.size:
+                    self._opened += 1
+                    con = None
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeout('Timed out waiting for a database connection.')
+                self._lock.wait(remaining)
+
+        if con is not None:
+            if self._healthy(con):
+                return con
+            # Keep its slot and just replace it with a fresh connection.
+            try:
+                con.close()
+            except sqlite3.Error:
+                pass
+
+        try:
+            return self._open()
+        except sqlite3.Error:
+            with self._lock:
+                self._opened -= 1
+                self._lock.notify()
+            raise
+
+    def checkin(self, con):
+        """Returns a connection to the pool. Anything it didn't commit is rolled back so the next user starts clean."""
+        try:
+            con.rollback()
+        except sqlite3.Error:
+            self._forget(con)
+            return
+        with self._lock:
+            if self._opened > self.size:
+                # The pool was shrunk while this connection was out.
+                self._opened -= 1
+                con.close()
+            else:
+                self._idle.append(con)
+            self._lock.notify()
+
+    def discard(self, con):
+        """Closes a connection that shouldn't be reused (e.g. it errored out) and frees up its slot."""
+        self._forget(con)
+
+    def closeAll(self):
+        """Closes every idle connection. Connections that are checked out are closed when they're returned."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+            self._lock.notify_all()
+        for con in idle:
+            con.close()
+
+
+pool = ConnectionPool(DATABASE_FILE)
+
+
+def configurePool(size=None, timeout=None):
+    """Changes the size and/or checkout timeout of the connection pool."""
+    with pool._lock:
+        if size is not None:
+            pool.size = size
+        if timeout is not None:
+            pool.timeout = timeout
+        pool._lock.notify_all()
+
+
+def configureStorage(**pragmas):
+    """Overrides entries in the storage profile, e.g. configureStorage(synchronous='FULL', mmap_size=0). Idle pooled
+    connections are closed so the new settings apply to every connection opened from now on."""
+    STORAGE_PROFILE.update(pragmas)
+    pool.closeAll()
+
+
+def checkpoint(con, mode='TRUNCATE'):
+    """Copies everything in the write-ahead log back into the database. Returns (busy, log pages, pages checkpointed)."""
+    return con.execute("PRAGMA wal_checkpoint(" + mode + ")").fetchone()
+
+
+def _backgroundLoop(name, interval, task):
+    # Nothing a single run does wrong (including not getting a connection at all) stops the thread.
+    while True:
+        time.sleep(interval)
+        con = None
+        try:
+            con = connect()
+            task(con)
+            # close() discards the connection itself if the commit fails.
+            done, con = con, None
+            close(done)
+        except Exception as e:
+            print("Background task " + name + " failed: " + str(e))
+        finally:
+            if con is not None:
+                pool.discard(con)
+
+
+def startBackgroundTask(name, interval, task):
+    """Starts a daemon thread that calls task(con) with a pooled connection every interval seconds. The connection is
+    committed and returned to the pool afterwards; the task is free to commit along the way too."""
+    t = threading.Thread(target=_backgroundLoop, args=(name, interval, task), name=name)
+    t.daemon = True
+    t.start()
+    return t
+
+
+def _periodicCheckpoint(con):
+    busy, logPages, checkpointed = checkpoint(con, 'PASSIVE')
+    if logPages < CHECKPOINT_TRUNCATE_PAGES:
+        return
+    con.execute("PRAGMA busy_timeout=" + str(CHECKPOINT_BUSY_TIMEOUT)).fetchall()
+    try:
+        checkpoint(con, 'TRUNCATE')
+    finally:
+        con.execute("PRAGMA busy_timeout=" + str(STORAGE_PROFILE['busy_timeout'])).fetchall()
+
+
+def startCheckpointer():
+    """Starts the background thread that periodically checkpoints the write-ahead log."""
+    return startBackgroundTask('checkpointer', CHECKPOINT_INTERVAL, _periodicCheckpoint)
+
 
 def connect():
-    """Opens a connection to the database and returns the connection object."""
-    return sqlite3.connect("telegraph.sqlite")
+    """Checks a connection to the database out of the pool and returns the connection object."""
+    return pool.checkout()
 
 
 def close(con):
-    """Closes any open connection to the database."""
+    """Hands a connection back to the pool."""
     # I guess every connection with the DB-API 2.0 bindings is treated like a transaction, so commit it.
-    con.commit()
-    con.close()
+    try:
+        con.commit()
+    except sqlite3.Error:
+        pool.discard(con)
+        raise
+    pool.checkin(con)
 
 
-def createTables():
-    """Creates the default tables in the database."""
+def rollback(con):
+    """Hands a connection back to the pool, throwing away anything it didn't commit."""
+    pool.checkin(con)
+
+
+def _runBatched(con, version, statements):
+    """Runs a batched step of migration version, one short write transaction per batch, until it stops changing rows
+    (or another process finishes the migration first)."""
+    c = con.cursor()
+    total = 0
+    while True:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute(queries.SELECT_SCHEMA_VERSION)
+        if c.fetchone()[0] >= version:
+            con.rollback()
+            return total
+        changed = 0
+        for sql in statements:
+            c.execute(sql, {'batchSize': MIGRATION_BATCH_SIZE})
+            changed += max(c.rowcount, 0)
+        con.commit()
+        if changed <= 0:
+            return total
+        total += changed
+        # Give anyone waiting on the write lock a chance to get in between batches.
+        time.sleep(MIGRATION_BATCH_PAUSE)
+
+
+def migrate(target=None):
+    """Applies, in order, every migration the database hasn't had yet (up to and including version target, if given).
+
+    Each migration's ordinary statements run in a single transaction along with recording its version, so a failed
+    migration leaves nothing behind. Batched steps commit as they go instead, which is fine since they only ever pick
+    up rows they haven't dealt with yet. The steps before a batched one are committed along with a note of how far the
+    migration has got (in schemaProgress), so an interrupted migration, or one another process is running at the same
+    time, carries on from the batched step next time instead of running the steps before it again."""
     con = connect()
     c = con.cursor()
-    c.execute(queries.CREATE_TABLE_USERS)
-    c.execute(queries.CREATE_TABLE_IMAGES)
-    c.execute(queries.CREATE_TABLE_IMAGE_HISTORY)
-    c.execute(queries.CREATE_TABLE_ACTIVE_ACCESS_TOKENS)
-    c.execute(queries.CREATE_TABLE_FRIENDS_LIST)
+    try:
+        c.execute(queries.CREATE_TABLE_SCHEMA_VERSION)
+        c.execute(queries.CREATE_TABLE_SCHEMA_PROGRESS)
+        con.commit()
+
+        for version, description, steps in queries.MIGRATIONS:
+            if target is not None and version > target:
+                break
+
+            announced = False
+            while True:
+                # Check again now that we hold the write lock, in case another process has just done (some of) this
+                # one.
+                c.execute("BEGIN IMMEDIATE")
+                c.execute(queries.SELECT_SCHEMA_VERSION)
+                if c.fetchone()[0] >= version:
+                    con.rollback()
+                    break
+                c.execute(queries.SELECT_SCHEMA_PROGRESS, {'version': version})
+                done = c.fetchone()[0]
+
+                if not announced:
+                    print("Migrating database to version " + str(version) + " (" + description + ")...")
+                    announced = True
+
+                batched = None
+                for i in range(done, len(steps)):
+                    if isinstance(steps[i], queries.Batched):
+                        batched = i
+                        break
+                    c.execute(steps[i])
+
+                if batched is None:
+                    c.execute(queries.INSERT_SCHEMA_VERSION, {'version': version, 'description': description})
+                    c.execute(queries.DELETE_SCHEMA_PROGRESS, {'version': version})
+                    con.commit()
+                    break
+
+                c.execute(queries.SET_SCHEMA_PROGRESS, {'version': version, 'step': batched})
+                con.commit()
+                print("\tBatched step changed " + str(_runBatched(con, version, steps[batched].statements)) + " rows.")
+                c.execute("BEGIN IMMEDIATE")
+                c.execute(queries.ADVANCE_SCHEMA_PROGRESS, {'version': version, 'step': batched + 1})
+                con.commit()
+    except:
+        pool.discard(con)
+        raise
     close(con)
 
 
+def createTables():
+    """Creates the tables in the database, or brings an existing database's tables up to date."""
+    migrate()
+
+
 def dropTables():
-    """Drops all the known tables in the database, useful for debugging."""
+    """Drops all the known tables in the database (and deletes the blob files that went with them), useful for
+    debugging."""
     con = connect()
     c = con.cursor()
     c.execute(queries.DROP_TABLE_USERS)
     c.execute(queries.DROP_TABLE_IMAGES)
+    c.execute(queries.DROP_TABLE_IMAGE_DATA)
+    c.execute(queries.DROP_TABLE_IMAGE_BLOBS)
+    c.execute(queries.DROP_TABLE_IMAGE_BLOB_DATA)
+    c.execute(queries.DROP_TABLE_IMAGE_BLOB_CHUNKS)
+    c.execute(queries.DROP_TABLE_IMAGE_VERSIONS)
     c.execute(queries.DROP_TABLE_IMAGE_HISTORY)
+    c.execute(queries.DROP_TABLE_INBOX)
     c.execute(queries.DROP_TABLE_ACTIVE_ACCESS_TOKENS)
     c.execute(queries.DROP_TABLE_FRIENDS_LIST)
+    c.execute(queries.DROP_TABLE_SCHEMA_VERSION)
+    c.execute(queries.DROP_TABLE_SCHEMA_PROGRESS)
     close(con)
-
-
+    if imagestore.BLOB_DIR is not None:
+        shutil.rmtree(imagestore.BLOB_DIR, ignore_errors=True)
@@ -0,0 +1,126 @@
+import struct
+import zlib
+
+# The parent is indexed in blocks of this many bytes, and the child is searched for them at every offset with a rolling
+# checksum (the same adler32 rsync uses), so changes that move the rest of the image along (like a header that grew)
+# still leave everything after them to be copied.
+BLOCK_SIZE = 32
+
+# Once more than this share of the child has had to be added as new bytes, diff gives up: a delta that size isn't worth
+# what it costs to find or to apply later.
+MAX_LITERAL_SHARE = 0.5
+
+_ADLER_MOD = 65521
+
+# Deltas start with this, so patch can tell them from the old kind (which start with zlib's header instead).
+_MAGIC = b'\x01'
+
+# Each op appends some new bytes, then copies some bytes from anywhere in the parent: (new bytes, offset, copied bytes),
+# followed by the new bytes themselves.
+_OP = struct.Struct('>III')
+
+# The old kind of op copied bytes from the parent at the current offset, then appended some new bytes.
+_LEGACY_OP = struct.Struct('>II')
+
+
+def _index(parent):
+    # Maps the checksum of each whole block of the parent to where the first block with it starts.
+    index = {}
+    for offset in range(0, len(parent) - BLOCK_SIZE + 1, BLOCK_SIZE):
+        index.setdefault(zlib.adler32(parent[offset:offset + BLOCK_SIZE]), offset)
+    return index
+
+
+def diff(parent, child):
+    """Returns a compact binary delta that turns parent into child, or None if they're too different for one to be
+    worth it."""
+    ops = []
+    literal = 0
+    limit = len(child) * MAX_LITERAL_SHARE
+    index = _index(parent)
+    pending = 0
+    pos = 0
+    end = len(child) - BLOCK_SIZE
+
+    if index and pos <= end:
+        checksum = zlib.adler32(child[:BLOCK_SIZE])
+        a, b = checksum & 0xffff, checksum >> 16
+        while True:
+            offset = index.get(checksum)
+            if offset is not None and parent[offset:offset + BLOCK_SIZE] == child[pos:pos + BLOCK_SIZE]:
+                # Grow the match back into the new bytes before it, then forwards as far as it goes.
+                start, source = pos, offset
+                while start > pending and source > 0 and parent[source - 1] == child[start - 1]:
+                    start -= 1
+                    source -= 1
+                stop, sourceStop = pos + BLOCK_SIZE, offset + BLOCK_SIZE
+                while stop + BLOCK_SIZE <= len(child) and \
+                        child[stop:stop + BLOCK_SIZE] == parent[sourceStop:sourceStop + BLOCK_SIZE]:
+                    stop += BLOCK_SIZE
+                    sourceStop += BLOCK_SIZE
+                while stop < len(child) and sourceStop < len(parent) and child[stop] == parent[sourceStop]:
+                    stop += 1
+                    sourceStop += 1
+
+                ops.append(_OP.pack(start - pending, source, stop - start))
+                ops.append(child[pending:start])
+                literal += start - pending
+                pending = pos = stop
+                if pos > end:
+                    break
+                checksum = zlib.adler32(child[pos:pos + BLOCK_SIZE])
+                a, b = checksum & 0xffff, checksum >> 16
+                continue
+
+            if pos == end:
+                break
+            if literal + pos - pending > limit:
+                return None
+            # Slide the window along a byte.
+            out, new = child[pos], child[pos + BLOCK_SIZE]
+            a = (a - out + new) % _ADLER_MOD
+            b = (b - BLOCK_SIZE * out + a - 1) % _ADLER_MOD
+            checksum = (b << 16) | a
+            pos += 1
+
+    if literal + len(child) - pending > limit:
+        return None
+    ops.append(_OP.pack(len(child) - pending, 0, 0))
+    ops.append(child[pending:])
+
+    return _MAGIC + zlib.compress(b''.join(ops))
+
+
+def _legacyPatch(parent, ops):
+    out = []
+    pos = 0
+    i = 0
+
+    while i < len(ops):
+        copy, literal = _LEGACY_OP.unpack_from(ops, i)
+        i += _LEGACY_OP.size
+        out.append(parent[pos:pos + copy])
+        out.append(ops[i:i + literal])
+        i += literal
+        pos += copy + literal
+
+    return b''.join(out)
+
+
+def patch(parent, delta):
+    """Applies a delta made by diff to parent and returns the child."""
+    if delta[:1] != _MAGIC:
+        return _legacyPatch(parent, zlib.decompress(delta))
+
+    ops = zlib.decompress(delta[1:])
+    out = []
+    i = 0
+
+    while i < len(ops):
+        literal, offset, copy = _OP.unpack_from(ops, i)
+        i += _OP.size
+        out.append(ops[i:i + literal])
+        i += literal
+        out.append(parent[offset:offset + copy])
+
+    return b''.join(out)
@@ -0,0 +1,512 @@
+import base64
+import binascii
+import collections
+import errno
+import hashlib
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+import delta
+
+# How an image payload is stored in imageBlobs. Clients always send and receive base64, but we only keep the decoded
+# bytes. Rows written before that change were base64 until migration 4 got to them.
+ENCODING_RAW = 'raw'
+ENCODING_ZLIB = 'zlib'
+ENCODING_BASE64 = 'base64'
+# Stored as is in a file of its own under BLOB_DIR rather than in imageBlobData.
+ENCODING_FILE = 'file'
+# Stored as is, BLOB_CHUNK_SIZE bytes per imageBlobChunks row, rather than in imageBlobData. Used for images bigger than
+# PACK_MAX_SIZE when BLOB_DIR is None.
+ENCODING_CHUNKS = 'chunks'
+
+# New blobs are written here, as BLOB_DIR/ab/abcdef... by content hash, so the server can hand the file straight to the
+# client (see openBlob). None keeps them in the database instead.
+BLOB_DIR = 'blobs'
+
+# Only keep the compressed copy if it's at least this much smaller, since most images are already compressed and
+# inflating them on every fetch isn't free.
+COMPRESSION_LEVEL = 6
+COMPRESSION_MIN_SAVING = 0.1
+
+# Every this many versions of an image, its history gets a keyframe instead of a delta.
+KEYFRAME_INTERVAL = 8
+
+# Images bigger than this are stored as they are, and always get a keyframe (an image a delta would be made against
+# counts too), so saving one never needs it in memory.
+PACK_MAX_SIZE = 1024 * 1024
+
+# Images at least this big are streamed out a chunk of this size at a time rather than read all at once.
+STREAM_MIN_SIZE = 1024 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# How big each imageBlobChunks row is. Offsets into stored blobs depend on it, so it can't change (migration 11 writes
+# chunks of this size too).
+BLOB_CHUNK_SIZE = 64 * 1024
+
+# Finished images (no hops left) never change, so /image/fetch keeps up to this many bytes of them in memory.
+IMAGE_CACHE_SIZE = 64 * 1024 * 1024
+
+# The garbage collector deletes unreferenced blobs this many at a time, every GC_INTERVAL seconds. Every
+# BLOB_SWEEP_INTERVAL seconds BLOB_DIR is also swept for files with no blob row at all (see sweepBlobFiles).
+GC_BATCH_SIZE = 100
+GC_INTERVAL = 300
+BLOB_SWEEP_INTERVAL = 3600
+
+# Blob files are written before the transaction that adds their row (see stageImage), so a file younger than this (in
+# seconds) might just not have had its row committed yet. Neither of the above deletes those.
+BLOB_GRACE_PERIOD = 3600
+
+# Signatures at the start of the image formats clients are likely to upload, and their content types.
+_MAGIC = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF8', 'image/gif'),
+]
+
+
+class ImageCache(object):
+    """A thread-safe LRU map of imageUUID to (content hash, image bytes), holding at most size bytes of images. It keeps
+    count of hits, misses and evictions."""
+
+    def __init__(self, size=IMAGE_CACHE_SIZE):
+        self.size = size
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, imageUUID):
+        """Returns (content hash, image bytes) for an image, or None if it isn't cached."""
+        with self._lock:
+            entry = self._entries.pop(imageUUID, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            # Put it back at the most recently used end.
+            self._entries[imageUUID] = entry
+            self.hits += 1
+            return entry
+
+    def put(self, imageUUID, h, data):
+        """Caches a finished image. Only call this for images that can't change any more."""
+        if len(data) > self.size:
+            return
+        with self._lock:
+            self._forget(imageUUID)
+            self._entries[imageUUID] = (h, data)
+            self.used += len(data)
+            while self.used > self.size:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.used -= len(evicted)
+                self.evictions += 1
+
+    def _forget(self, imageUUID):
+        entry = self._entries.pop(imageUUID, None)
+        if entry is not None:
+            self.used -= len(entry[1])
+
+    def invalidate(self, imageUUID):
+        """Forgets an image, e.g. because everyone has seen it."""
+        with self._lock:
+            self._forget(imageUUID)
+
+    def invalidateBlob(self, h):
+        """Forgets every image whose bytes are the blob with hash h."""
+        with self._lock:
+            for imageUUID in [u for u, (entryHash, _) in self._entries.items() if entryHash == h]:
+                self._forget(imageUUID)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.used = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.used, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+imageCache = ImageCache()
+
+
+def decodeUpload(text):
+    """Decodes the base64 image a client sent. Raises ValueError if it isn't valid base64."""
+    try:
+        return base64.b64decode(text)
+    except (binascii.Error, TypeError):
+        raise ValueError('Image is not valid base64.')
+
+
+def encodeDownload(data):
+    """Encodes image bytes as base64 text for clients that expect it inside JSON."""
+    return base64.b64encode(data).decode('ascii')
+
+
+def encodeDownloadChunks(chunks):
+    """Like encodeDownload, but for image bytes that come a chunk at a time. Yields the base64 a piece at a time."""
+    pending = b''
+    for chunk in chunks:
+        chunk = pending + chunk
+        whole = len(chunk) - len(chunk) % 3
+        pending = chunk[whole:]
+        if whole:
+            yield base64.b64encode(chunk[:whole])
+    yield base64.b64encode(pending)
+
+
+def contentHash(data):
+    """The key an image's bytes are stored under."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def _hashFile(f):
+    # Returns (content hash, size) of a file's contents, reading it a chunk at a time.
+    hasher = hashlib.sha256()
+    size = 0
+    f.seek(0)
+    while True:
+        chunk = f.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        hasher.update(chunk)
+        size += len(chunk)
+    return hasher.hexdigest(), size
+
+
+def pack(data):
+    """Picks the cheapest way to store some image bytes. Returns (stored bytes, encoding)."""
+    compressed = zlib.compress(data, COMPRESSION_LEVEL)
+    if len(compressed) <= len(data) * (1 - COMPRESSION_MIN_SAVING):
+        return compressed, ENCODING_ZLIB
+    return data, ENCODING_RAW
+
+
+def unpack(stored, encoding):
+    """Turns stored image bytes back into the image itself."""
+    if encoding == ENCODING_ZLIB:
+        return zlib.decompress(stored)
+    if encoding == ENCODING_BASE64:
+        return decodeUpload(stored)
+    return bytes(stored)
+
+
+def blobPath(h):
+    """Where the blob with hash h lives if it's stored as a file."""
+    return os.path.join(BLOB_DIR, h[:2], h)
+
+
+def _writeBlobFile(h, f):
+    # Copies the file f into place a chunk at a time. Written to a temporary file and renamed into place, and synced
+    # before the row pointing at it can be committed, so a blob file is always complete. Writing the same hash twice
+    # just writes the same bytes again.
+    directory = os.path.dirname(blobPath(h))
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    f.seek(0)
+    with tempfile.NamedTemporaryFile(dir=directory, prefix='.' + h[:8], delete=False) as out:
+        shutil.copyfileobj(f, out, STREAM_CHUNK_SIZE)
+        out.flush()
+        os.fsync(out.fileno())
+    os.rename(out.name, blobPath(h))
+
+
+class StagedImage(object):
+    """An uploaded image that's ready to be saved (see stageImage). data is its bytes, or None if it's bigger than
+    PACK_MAX_SIZE, in which case they're only ever read from file."""
+
+    def __init__(self, f):
+        self.file = f
+        self.hash, self.size = _hashFile(f)
+        self.data = None
+        if self.size <= PACK_MAX_SIZE:
+            f.seek(0)
+            self.data = f.read()
+        self.written = False
+
+
+def stageImage(c, f):
+    """Gets an uploaded image, in the file f, ready to be passed to saveImage. Call it before starting the transaction
+    that saves it: with BLOB_DIR set, it copies the image to its blob file now (unless we've already got it), so the
+    disk I/O never happens while holding the write lock. If that transaction is rolled back, the file is left for
+    sweepBlobFiles. f has to stay open until saveImage is done with it."""
+    staged = StagedImage(f)
+    if BLOB_DIR is not None:
+        c.execute("SELECT 1 FROM imageBlobs WHERE contentHash=:contentHash AND refCount>0", {'contentHash': staged.hash})
+        if c.fetchone() is None:
+            _writeBlobFile(staged.hash, f)
+            staged.written = True
+    return staged
+
+
+def _reference(c, staged):
+    """Adds a reference to the blob for a staged image, storing the image as that blob first if we don't have it
+    yet."""
+    h = staged.hash
+    c.execute("UPDATE imageBlobs SET refCount=refCount+1 WHERE contentHash=:contentHash", {'contentHash': h})
+    if c.rowcount > 0:
+        return
+
+    if BLOB_DIR is not None:
+        # Only if we had the blob when it was staged but it's been collected since, which is rare enough to just write
+        # it out now.
+        if not staged.written:
+            _writeBlobFile(h, staged.file)
+        c.execute(
+            "INSERT INTO imageBlobs (contentHash, size, encoding, refCount) VALUES (:contentHash, :size, :encoding, 1)",
+            {'contentHash': h, 'size': staged.size, 'encoding': ENCODING_FILE})
+        return
+
+    if staged.data is not None:
+        stored, encoding = pack(staged.data)
+    else:
+        stored, encoding = None, ENCODING_CHUNKS
+    c.execute(
+        "INSERT INTO imageBlobs (contentHash, size, encoding, refCount) VALUES (:contentHash, :size, :encoding, 1)",
+        {'contentHash': h, 'size': staged.size, 'encoding': encoding})
+    blobID = c.lastrowid
+    if stored is not None:
+        c.execute("INSERT INTO imageBlobData (blobID, data) VALUES (:blobID, :data)",
+                  {'blobID': blobID, 'data': sqlite3.Binary(stored)})
+        return
+
+    staged.file.seek(0)
+    seq = 0
+    while True:
+        chunk = staged.file.read(BLOB_CHUNK_SIZE)
+        if not chunk:
+            return
+        c.execute("INSERT INTO imageBlobChunks (blobID, seq, data) VALUES (:blobID, :seq, :data)",
+                  {'blobID': blobID, 'seq': seq, 'data': sqlite3.Binary(chunk)})
+        seq += 1
+
+
+def _release(c, h):
+    """Drops a reference to the blob with hash h. It's left for the garbage collector once nothing refers to it."""
+    c.execute("UPDATE imageBlobs SET refCount=refCount-1 WHERE contentHash=:contentHash", {'contentHash': h})
+
+
+def loadBlob(c, h):
+    """Returns the image bytes stored under hash h, or None if there's no such blob (any more)."""
+    c.execute(
+        "SELECT imageBlobData.data, imageBlobs.encoding, imageBlobs.blobID FROM imageBlobs LEFT JOIN imageBlobData ON imageBlobData.blobID=imageBlobs.blobID WHERE imageBlobs.contentHash=:contentHash",
+        {'contentHash': h})
+    r = c.fetchone()
+    if r is None:
+        return None
+    stored, encoding, blobID = r
+
+    if encoding == ENCODING_FILE:
+        with open(blobPath(h), 'rb') as f:
+            return f.read()
+    if encoding == ENCODING_CHUNKS:
+        c.execute("SELECT data FROM imageBlobChunks WHERE blobID=:blobID ORDER BY seq", {'blobID': blobID})
+        return b''.join(bytes(r[0]) for r in c.fetchall())
+    return unpack(stored, encoding)
+
+
+def openBlob(c, h, encoding):
+    """Returns a file to read the image bytes stored under hash h from, or None if there's no such blob (any more).
+    That's the blob's own file if it has one, which lets the server send it without copying it through Python (with
+    wsgi.file_wrapper), otherwise an in-memory copy, so use blobChunk for ENCODING_CHUNKS blobs instead."""
+    if encoding == ENCODING_FILE:
+        try:
+            return open(blobPath(h), 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    data = loadBlob(c, h)
+    if data is None:
+        return None
+    return io.BytesIO(data)
+
+
+def _recordVersion(c, imageID, staged, parent, username):
+    """Adds the next version to an image's history, as a delta against parent (the version before) where possible."""
+    c.execute("SELECT COALESCE(MAX(version), -1) + 1 FROM imageVersions WHERE imageID=:imageID", {'imageID': imageID})
+    version = c.fetchone()[0]
+
+    change = None
+    if parent is not None and staged.data is not None and version % KEYFRAME_INTERVAL != 0:
+        change = delta.diff(parent, staged.data)
+        if change is not None and len(change) >= staged.size:
+            change = None
+
+    if change is None:
+        _reference(c, staged)
+
+    c.execute(
+        "INSERT INTO imageVersions (imageID, version, username, contentHash, isKeyframe, delta) VALUES (:imageID, :version, :username, :contentHash, :isKeyframe, :delta)",
+        {'imageID': imageID, 'version': version, 'username': username, 'contentHash': staged.hash,
+         'isKeyframe': 1 if change is None else 0, 'delta': None if change is None else sqlite3.Binary(change)})
+
+
+def saveImage(c, imageID, staged, username=None):
+    """Sets the image bytes for an image, from stageImage, adds them to its history, and returns their hash. Bytes
+    we've already got are never stored twice, and saving the same bytes an image already has only adds an empty delta
+    to its history."""
+    h = staged.hash
+
+    c.execute(
+        "SELECT images.contentHash, imageBlobs.size FROM images LEFT JOIN imageBlobs ON imageBlobs.contentHash=images.contentHash WHERE images.imageID=:imageID",
+        {'imageID': imageID})
+    old, oldSize = c.fetchone()
+
+    if old == h:
+        parent = staged.data
+    else:
+        parent = None
+        if old is not None and staged.data is not None and oldSize is not None and oldSize <= PACK_MAX_SIZE:
+            parent = loadBlob(c, old)
+        _reference(c, staged)
+        c.execute("UPDATE images SET contentHash=:contentHash WHERE imageID=:imageID",
+                  {'contentHash': h, 'imageID': imageID})
+        if old is not None:
+            _release(c, old)
+
+    _recordVersion(c, imageID, staged, parent, username)
+    return h
+
+
+def imageInfo(c, imageUUID):
+    """Returns (content hash, size, hops left, encoding) for an image that hasn't been retired, without loading the image
+    itself, or None if there's no such image."""
+    c.execute(
+        "SELECT images.contentHash, imageBlobs.size, images.hopsLeft, imageBlobs.encoding FROM images JOIN imageBlobs ON imageBlobs.contentHash=images.contentHash WHERE images.imageUUID=:imageUUID AND images.hopsLeft>=0",
+        {'imageUUID': imageUUID})
+    return c.fetchone()
+
+
+def blobChunk(c, h, seq):
+    """Returns chunk seq (counting from 0) of an ENCODING_CHUNKS blob with hash h, or None if it has no such chunk or
+    there's no such blob (any more)."""
+    c.execute(
+        "SELECT imageBlobChunks.data FROM imageBlobs JOIN imageBlobChunks ON imageBlobChunks.blobID=imageBlobs.blobID WHERE imageBlobs.contentHash=:contentHash AND imageBlobChunks.seq=:seq",
+        {'contentHash': h, 'seq': seq})
+    r = c.fetchone()
+    return None if r is None else bytes(r[0])
+
+
+def peekBlob(c, h, size=16):
+    """Returns the first few bytes of an ENCODING_CHUNKS blob with hash h, e.g. for mimeType."""
+    c.execute(
+        "SELECT substr(imageBlobChunks.data, 1, :size) FROM imageBlobs JOIN imageBlobChunks ON imageBlobChunks.blobID=imageBlobs.blobID WHERE imageBlobs.contentHash=:contentHash AND imageBlobChunks.seq=0",
+        {'contentHash': h, 'size': size})
+    r = c.fetchone()
+    return b'' if r is None else bytes(r[0])
+
+
+def mimeType(data):
+    """Guesses an image's content type from its first few bytes."""
+    for magic, mime in _MAGIC:
+        if data.startswith(magic):
+            return mime
+    return 'application/octet-stream'
+
+
+def loadVersion(c, imageID, version):
+    """Rebuilds the image bytes an image had at some version (0 being how it was created), or returns None if it never
+    had that version."""
+    c.execute(
+        "SELECT MAX(version) FROM imageVersions WHERE imageID=:imageID AND version<=:version AND isKeyframe=1",
+        {'imageID': imageID, 'version': version})
+    keyframe = c.fetchone()[0]
+    if keyframe is None:
+        return None
+
+    c.execute(
+        "SELECT version, contentHash, delta FROM imageVersions WHERE imageID=:imageID AND version BETWEEN :keyframe AND :version ORDER BY version",
+        {'imageID': imageID, 'keyframe': keyframe, 'version': version})
+    rows = c.fetchall()
+    if rows[-1][0] != version:
+        return None
+
+    data = loadBlob(c, rows[0][1])
+    for r in rows[1:]:
+        data = delta.patch(data, r[2])
+    return data
+
+
+def _removeOrphans(con, paths):
+    """Deletes whichever of the files at paths (under BLOB_DIR) no imageBlobs row refers to, along with any temporary
+    files left by a write that never finished, unless they're younger than BLOB_GRACE_PERIOD. Returns how many were
+    deleted."""
+    c = con.cursor()
+    cutoff = time.time() - BLOB_GRACE_PERIOD
+    deleted = 0
+    for path in paths:
+        directory, name = os.path.split(path)
+        try:
+            if name.startswith('.'):
+                # Nothing spends that long writing one.
+                if os.stat(path).st_mtime <= cutoff:
+                    os.remove(path)
+                    deleted += 1
+                continue
+
+            c.execute("SELECT 1 FROM imageBlobs WHERE contentHash=:contentHash", {'contentHash': name})
+            if c.fetchone() is not None:
+                continue
+            # Moved out of the way before its age is checked, so it can't be written again in between and then deleted
+            # anyway. If it has just been written, it's put back.
+            doomed = os.path.join(directory, '.gc-' + name)
+            os.rename(path, doomed)
+            if os.stat(doomed).st_mtime > cutoff:
+                os.rename(doomed, path)
+            else:
+                os.remove(doomed)
+                deleted += 1
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    return deleted
+
+
+def collectGarbage(con):
+    """Deletes blobs that no image refers to any more, a small batch per transaction. Returns how many were deleted."""
+    c = con.cursor()
+    deleted = 0
+    while True:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT blobID, contentHash, encoding FROM imageBlobs WHERE refCount<=0 LIMIT :batchSize",
+                  {'batchSize': GC_BATCH_SIZE})
+        rows = c.fetchall()
+        batch = [(r[0],) for r in rows]
+        c.executemany("DELETE FROM imageBlobData WHERE blobID=?", batch)
+        c.executemany("DELETE FROM imageBlobChunks WHERE blobID=?", batch)
+        c.executemany("DELETE FROM imageBlobs WHERE blobID=? AND refCount<=0", batch)
+        con.commit()
+        for r in rows:
+            imageCache.invalidateBlob(r[1])
+        # Files only go once their rows are gone for good, and not if the same blob has been staged again since.
+        _removeOrphans(con, [blobPath(r[1]) for r in rows if r[2] == ENCODING_FILE])
+        deleted += len(batch)
+        if len(batch) < GC_BATCH_SIZE:
+            return deleted
+
+
+def sweepBlobFiles(con):
+    """Deletes files in BLOB_DIR that no blob row refers to, such as ones written for an upload that was then rolled
+    back, or left behind by a crash. Returns how many were deleted."""
+    if BLOB_DIR is None or not os.path.isdir(BLOB_DIR):
+        return 0
+    paths = []
+    for directory, _, names in os.walk(BLOB_DIR):
+        paths.extend(os.path.join(directory, name) for name in names)
+    deleted = 0
+    for i in range(0, len(paths), GC_BATCH_SIZE):
+        deleted += _removeOrphans(con, paths[i:i + GC_BATCH_SIZE])
+    return deleted
@@ -22,6 +22,7 @@ CREATE_TABLE_ACTIVE_ACCESS_TOKENS = """
     )
 """
 
+# The image data itself no longer lives here, see CREATE_TABLE_IMAGE_BLOBS.
 CREATE_TABLE_IMAGES = """
     CREATE TABLE IF NOT EXISTS images (
         imageID INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -39,6 +40,69 @@ CREATE_TABLE_IMAGES = """
     )
 """
 
+# Image payloads, kept out of the images table so that queries over image metadata only ever touch small rows. Keyed by
+# the image's imageID. Replaced by imageBlobs (migration 5).
+CREATE_TABLE_IMAGE_DATA = """
+    CREATE TABLE IF NOT EXISTS imageData (
+        imageID INTEGER PRIMARY KEY,
+        image BLOB NOT NULL,
+        FOREIGN KEY (imageID) REFERENCES images (imageID)
+    )
+"""
+
+# Image payloads are stored by the SHA-256 of the image bytes, so identical images are only ever stored once. Each image
+# row points at one by its contentHash, and refCount counts how many do; blobs nobody points at any more are deleted by
+# imagestore.collectGarbage. The payload itself is in imageBlobData so that reference counting only rewrites small rows,
+# or for blobs with the 'chunks' encoding, split across imageBlobChunks, or for ones with the 'file' encoding, in a file
+# of its own under imagestore.BLOB_DIR.
+CREATE_TABLE_IMAGE_BLOBS = """
+    CREATE TABLE IF NOT EXISTS imageBlobs (
+        blobID INTEGER PRIMARY KEY,
+        contentHash TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        encoding TEXT NOT NULL,
+        refCount INTEGER DEFAULT 0 NOT NULL
+    )
+"""
+
+CREATE_TABLE_IMAGE_BLOB_DATA = """
+    CREATE TABLE IF NOT EXISTS imageBlobData (
+        blobID INTEGER PRIMARY KEY,
+        data BLOB NOT NULL,
+        FOREIGN KEY (blobID) REFERENCES imageBlobs (blobID)
+    )
+"""
+
+# Big blobs are stored a piece at a time (in order of seq, each imagestore.BLOB_CHUNK_SIZE bytes but the last), so they
+# can be read back a piece at a time too.
+CREATE_TABLE_IMAGE_BLOB_CHUNKS = """
+    CREATE TABLE IF NOT EXISTS imageBlobChunks (
+        chunkID INTEGER PRIMARY KEY,
+        blobID INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        FOREIGN KEY (blobID) REFERENCES imageBlobs (blobID)
+    )
+"""
+
+# Every version an image has been through, one per hop. Most are stored as a delta (see delta.py) against the version
+# before, with a keyframe every so often so rebuilding a version never has to apply too many. Keyframes don't store any
+# bytes of their own, they just hold a reference to the blob with that version's contentHash.
+CREATE_TABLE_IMAGE_VERSIONS = """
+    CREATE TABLE IF NOT EXISTS imageVersions (
+        versionID INTEGER PRIMARY KEY AUTOINCREMENT,
+        imageID INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        username TEXT,
+        createdOn INTEGER DEFAULT CURRENT_TIMESTAMP NOT NULL,
+        contentHash TEXT NOT NULL,
+        isKeyframe INTEGER NOT NULL,
+        delta BLOB,
+        FOREIGN KEY (imageID) REFERENCES images (imageID),
+        FOREIGN KEY (username) REFERENCES users (username)
+    )
+"""
+
 # Use to keep a one-to-many relationship between images and their previous owners to determine who to show the completed
 # image to once it runs out of hops.
 CREATE_TABLE_IMAGE_HISTORY = """
@@ -52,6 +116,22 @@ CREATE_TABLE_IMAGE_HISTORY = """
     )
 """
 
+# What /image/query returns for each user, kept up to date whenever an image or its history changes (see
+# telegraphic.refreshInbox): images waiting for the user to draw on them, and finished images they worked on but haven't
+# seen yet. It's kept in the order /image/query returns it: waiting images first, then finished ones, each oldest first.
+CREATE_TABLE_INBOX = """
+    CREATE TABLE IF NOT EXISTS inbox (
+        username TEXT NOT NULL,
+        finished INTEGER NOT NULL,
+        imageID INTEGER NOT NULL,
+        imageUUID TEXT NOT NULL,
+        previousUser TEXT,
+        editTime INTEGER NOT NULL,
+        hopsLeft INTEGER NOT NULL,
+        PRIMARY KEY (username, finished, imageID)
+    ) WITHOUT ROWID
+"""
+
 CREATE_TABLE_FRIENDS_LIST = """
     CREATE TABLE IF NOT EXISTS friends (
         username TEXT NOT NULL,
@@ -74,10 +154,410 @@ DROP_TABLE_IMAGES = """
     DROP TABLE IF EXISTS images
 """
 
+DROP_TABLE_IMAGE_DATA = """
+    DROP TABLE IF EXISTS imageData
+"""
+
+DROP_TABLE_IMAGE_BLOBS = """
+    DROP TABLE IF EXISTS imageBlobs
+"""
+
+DROP_TABLE_IMAGE_BLOB_DATA = """
+    DROP TABLE IF EXISTS imageBlobData
+"""
+
+DROP_TABLE_IMAGE_BLOB_CHUNKS = """
+    DROP TABLE IF EXISTS imageBlobChunks
+"""
+
+DROP_TABLE_IMAGE_VERSIONS = """
+    DROP TABLE IF EXISTS imageVersions
+"""
+
 DROP_TABLE_IMAGE_HISTORY = """
     DROP TABLE IF EXISTS imageHistory
 """
 
+DROP_TABLE_INBOX = """
+    DROP TABLE IF EXISTS inbox
+"""
+
 DROP_TABLE_FRIENDS_LIST = """
     DROP TABLE IF EXISTS friends
-"""
\ No newline at end of file
+"""
+
+
+# ######################################################################################################################
+# Indexes
+# ######################################################################################################################
+
+# Usernames and phone numbers are checked for uniqueness on registration, and username is what everything else refers
+# to users by.
+CREATE_INDEX_USERS_USERNAME = """
+    CREATE UNIQUE INDEX IF NOT EXISTS usersUsername ON users (username)
+"""
+
+CREATE_INDEX_USERS_PHONE_NUMBER = """
+    CREATE UNIQUE INDEX IF NOT EXISTS usersPhoneNumber ON users (phoneNumber)
+"""
+
+# Looked up on every authenticated request.
+CREATE_INDEX_ACTIVE_ACCESS_TOKENS_TOKEN = """
+    CREATE UNIQUE INDEX IF NOT EXISTS activeAccessTokensAccessToken ON activeAccessTokens (accessToken)
+"""
+
+CREATE_INDEX_IMAGES_UUID = """
+    CREATE UNIQUE INDEX IF NOT EXISTS imagesImageUUID ON images (imageUUID)
+"""
+
+# The "waiting for you to draw on it" half of /image/query.
+CREATE_INDEX_IMAGES_NEXT_USER = """
+    CREATE INDEX IF NOT EXISTS imagesNextUserHopsLeft ON images (nextUser, hopsLeft)
+"""
+
+# The "finished and you haven't seen it yet" half of /image/query.
+CREATE_INDEX_IMAGE_HISTORY_USERNAME = """
+    CREATE INDEX IF NOT EXISTS imageHistoryUsernameViewed ON imageHistory (username, viewed)
+"""
+
+# A user only gets one history row per image; /image/update checks this before adding one.
+CREATE_INDEX_IMAGE_HISTORY_IMAGE = """
+    CREATE UNIQUE INDEX IF NOT EXISTS imageHistoryImageUUIDUsername ON imageHistory (imageUUID, username)
+"""
+
+CREATE_INDEX_IMAGE_BLOBS_HASH = """
+    CREATE UNIQUE INDEX IF NOT EXISTS imageBlobsContentHash ON imageBlobs (contentHash)
+"""
+
+# Lets the garbage collector find unreferenced blobs without scanning the rest.
+CREATE_INDEX_IMAGE_BLOBS_UNREFERENCED = """
+    CREATE INDEX IF NOT EXISTS imageBlobsUnreferenced ON imageBlobs (blobID) WHERE refCount<=0
+"""
+
+CREATE_INDEX_IMAGE_BLOB_CHUNKS_SEQ = """
+    CREATE UNIQUE INDEX IF NOT EXISTS imageBlobChunksBlobIDSeq ON imageBlobChunks (blobID, seq)
+"""
+
+CREATE_INDEX_IMAGE_VERSIONS_VERSION = """
+    CREATE UNIQUE INDEX IF NOT EXISTS imageVersionsImageIDVersion ON imageVersions (imageID, version)
+"""
+
+# Token expiry: the purge looks tokens up by either timestamp, and logging in looks up a user's other tokens to enforce
+# the per-user cap.
+CREATE_INDEX_ACTIVE_ACCESS_TOKENS_ISSUED = """
+    CREATE INDEX IF NOT EXISTS activeAccessTokensIssuedAt ON activeAccessTokens (issuedAt)
+"""
+
+CREATE_INDEX_ACTIVE_ACCESS_TOKENS_LAST_USED = """
+    CREATE INDEX IF NOT EXISTS activeAccessTokensLastUsedAt ON activeAccessTokens (lastUsedAt)
+"""
+
+CREATE_INDEX_ACTIVE_ACCESS_TOKENS_USERNAME = """
+    CREATE INDEX IF NOT EXISTS activeAccessTokensUsername ON activeAccessTokens (username)
+"""
+
+# /image/query used to read both of its halves straight out of these, without touching the tables. They replaced
+# imagesNextUserHopsLeft and imageHistoryUsernameViewed (migration 8), and were dropped again once it used the inbox
+# table instead (migration 9).
+CREATE_INDEX_IMAGES_INBOX_PENDING = """
+    CREATE INDEX IF NOT EXISTS imagesInboxPending ON images (nextUser, hopsLeft, imageUUID, previousUser, editTime)
+"""
+
+CREATE_INDEX_IMAGES_INBOX_FINISHED = """
+    CREATE INDEX IF NOT EXISTS imagesInboxFinished ON images (imageUUID, hopsLeft, previousUser, editTime)
+"""
+
+CREATE_INDEX_IMAGE_HISTORY_INBOX = """
+    CREATE INDEX IF NOT EXISTS imageHistoryInbox ON imageHistory (username, viewed, imageUUID)
+"""
+
+# Refreshing an image's inbox entries starts by deleting the old ones.
+CREATE_INDEX_INBOX_IMAGE = """
+    CREATE INDEX IF NOT EXISTS inboxImageUUID ON inbox (imageUUID)
+"""
+
+# The indexes created by migration 2.
+INDEXES = [
+    CREATE_INDEX_USERS_USERNAME,
+    CREATE_INDEX_USERS_PHONE_NUMBER,
+    CREATE_INDEX_ACTIVE_ACCESS_TOKENS_TOKEN,
+    CREATE_INDEX_IMAGES_UUID,
+    CREATE_INDEX_IMAGES_NEXT_USER,
+    CREATE_INDEX_IMAGE_HISTORY_USERNAME,
+    CREATE_INDEX_IMAGE_HISTORY_IMAGE,
+]
+
+
+# ######################################################################################################################
+# Migrations
+# ######################################################################################################################
+
+CREATE_TABLE_SCHEMA_VERSION = """
+    CREATE TABLE IF NOT EXISTS schemaVersion (
+        version INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        appliedOn INTEGER DEFAULT CURRENT_TIMESTAMP NOT NULL
+    )
+"""
+
+DROP_TABLE_SCHEMA_VERSION = """
+    DROP TABLE IF EXISTS schemaVersion
+"""
+
+SELECT_SCHEMA_VERSION = """
+    SELECT COALESCE(MAX(version), 0) FROM schemaVersion
+"""
+
+INSERT_SCHEMA_VERSION = """
+    INSERT INTO schemaVersion (version, description) VALUES (:version, :description)
+"""
+
+# How far through a migration with batched steps the runner has got: every step before `step` is done. That way a
+# migration interrupted partway (or being run by another process at the same time) carries on from there, rather than
+# running steps like ALTER TABLE ... ADD COLUMN a second time.
+CREATE_TABLE_SCHEMA_PROGRESS = """
+    CREATE TABLE IF NOT EXISTS schemaProgress (
+        version INTEGER PRIMARY KEY,
+        step INTEGER NOT NULL
+    )
+"""
+
+DROP_TABLE_SCHEMA_PROGRESS = """
+    DROP TABLE IF EXISTS schemaProgress
+"""
+
+SELECT_SCHEMA_PROGRESS = """
+    SELECT COALESCE(MAX(step), 0) FROM schemaProgress WHERE version=:version
+"""
+
+SET_SCHEMA_PROGRESS = """
+    INSERT OR REPLACE INTO schemaProgress (version, step) VALUES (:version, :step)
+"""
+
+# Only ever moves forward, in case another process has got further in the meantime.
+ADVANCE_SCHEMA_PROGRESS = """
+    UPDATE schemaProgress SET step=:step WHERE version=:version AND step<:step
+"""
+
+DELETE_SCHEMA_PROGRESS = """
+    DELETE FROM schemaProgress WHERE version=:version
+"""
+
+class Batched(object):
+    """A migration step that touches a lot of rows (backfills, copies) and so shouldn't hold the write lock for the
+    whole migration. The runner executes its statements over and over, each round in its own small transaction and
+    binding :batchSize, until a round doesn't change anything, so the statements need to only pick up rows that haven't
+    been dealt with yet."""
+
+    def __init__(self, *statements):
+        self.statements = statements
+
+# (version, description, steps), in the order they're applied. Once a migration has shipped don't edit it (or any of
+# the statements it uses), add a new one instead - databases that already have it won't run it again.
+MIGRATIONS = [
+    (1, 'Initial tables', [
+        CREATE_TABLE_USERS,
+        CREATE_TABLE_IMAGES,
+        CREATE_TABLE_IMAGE_HISTORY,
+        CREATE_TABLE_ACTIVE_ACCESS_TOKENS,
+        CREATE_TABLE_FRIENDS_LIST,
+    ]),
+    (2, 'Lookup indexes', INDEXES),
+    (3, 'Move image data out of the images table', [
+        CREATE_TABLE_IMAGE_DATA,
+        Batched("""
+            INSERT INTO imageData (imageID, image)
+                SELECT imageID, image FROM images
+                WHERE imageID > (SELECT COALESCE(MAX(imageID), 0) FROM imageData)
+                ORDER BY imageID LIMIT :batchSize
+        """),
+        # Empty the old column out a batch at a time. It's left in place, empty, rather than dropped, since DROP COLUMN
+        # needs SQLite 3.35 or later; /image/create fills it with x'' to satisfy its NOT NULL.
+        Batched("""
+            UPDATE images SET image=x'' WHERE imageID IN (
+                SELECT imageID FROM images WHERE length(image)>0 LIMIT :batchSize
+            )
+        """),
+    ]),
+    # Everything stored so far is the base64 text clients sent us. The partial index is what lets each batch find rows
+    # still to do without reading through every blob to get at the encoding column behind it.
+    (4, 'Store images as bytes instead of base64', [
+        """
+            ALTER TABLE imageData ADD COLUMN encoding TEXT DEFAULT 'base64' NOT NULL
+        """,
+        """
+            CREATE INDEX imageDataBase64 ON imageData (imageID) WHERE encoding='base64'
+        """,
+        Batched("""
+            UPDATE imageData SET image=decodeLegacyImage(image), encoding='raw' WHERE imageID IN (
+                SELECT imageID FROM imageData WHERE encoding='base64' LIMIT :batchSize
+            )
+        """),
+        """
+            DROP INDEX imageDataBase64
+        """,
+    ]),
+    # Each round hashes the first batch of imageData rows, adds (or references) their blobs, and then deletes them.
+    (5, 'Content-addressed image storage', [
+        CREATE_TABLE_IMAGE_BLOBS,
+        CREATE_TABLE_IMAGE_BLOB_DATA,
+        CREATE_INDEX_IMAGE_BLOBS_HASH,
+        CREATE_INDEX_IMAGE_BLOBS_UNREFERENCED,
+        """
+            ALTER TABLE images ADD COLUMN contentHash TEXT
+        """,
+        Batched("""
+            UPDATE images SET contentHash=(
+                SELECT imageHash(image, encoding) FROM imageData WHERE imageData.imageID=images.imageID
+            ) WHERE imageID IN (SELECT imageID FROM imageData ORDER BY imageID LIMIT :batchSize)
+        """, """
+            INSERT INTO imageBlobs (contentHash, size, encoding, refCount)
+                SELECT images.contentHash, imageSize(batch.image, batch.encoding), batch.encoding, 1
+                FROM (SELECT * FROM imageData ORDER BY imageID LIMIT :batchSize) AS batch
+                JOIN images ON images.imageID=batch.imageID
+                WHERE 1
+                ON CONFLICT (contentHash) DO UPDATE SET refCount=refCount+1
+        """, """
+            INSERT OR IGNORE INTO imageBlobData (blobID, data)
+                SELECT imageBlobs.blobID, batch.image
+                FROM (SELECT * FROM imageData ORDER BY imageID LIMIT :batchSize) AS batch
+                JOIN images ON images.imageID=batch.imageID
+                JOIN imageBlobs ON imageBlobs.contentHash=images.contentHash
+        """, """
+            DELETE FROM imageData WHERE imageID IN (SELECT imageID FROM imageData ORDER BY imageID LIMIT :batchSize)
+        """),
+        DROP_TABLE_IMAGE_DATA,
+    ]),
+    # Whatever each image looks like right now becomes its first version, as a keyframe.
+    (6, 'Image version history', [
+        CREATE_TABLE_IMAGE_VERSIONS,
+        CREATE_INDEX_IMAGE_VERSIONS_VERSION,
+        Batched("""
+            UPDATE imageBlobs SET refCount=refCount+(
+                SELECT COUNT(*) FROM images
+                WHERE images.contentHash=imageBlobs.contentHash
+                AND images.imageID IN (
+                    SELECT imageID FROM images
+                    WHERE contentHash IS NOT NULL
+                    AND imageID > (SELECT COALESCE(MAX(imageID), 0) FROM imageVersions)
+                    ORDER BY imageID LIMIT :batchSize
+                )
+            ) WHERE contentHash IN (
+                SELECT contentHash FROM images
+                WHERE contentHash IS NOT NULL
+                AND imageID > (SELECT COALESCE(MAX(imageID), 0) FROM imageVersions)
+                ORDER BY imageID LIMIT :batchSize
+            )
+        """, """
+            INSERT INTO imageVersions (imageID, version, username, contentHash, isKeyframe)
+                SELECT imageID, 0, previousUser, contentHash, 1 FROM images
+                WHERE contentHash IS NOT NULL
+                AND imageID > (SELECT COALESCE(MAX(imageID), 0) FROM imageVersions)
+                ORDER BY imageID LIMIT :batchSize
+        """),
+    ]),
+    # Unix timestamps for when each token was issued and last used. Existing tokens count as last used when issued.
+    (7, 'Access token expiry', [
+        """
+            ALTER TABLE activeAccessTokens ADD COLUMN issuedAt INTEGER
+        """,
+        """
+            ALTER TABLE activeAccessTokens ADD COLUMN lastUsedAt INTEGER
+        """,
+        CREATE_INDEX_ACTIVE_ACCESS_TOKENS_ISSUED,
+        CREATE_INDEX_ACTIVE_ACCESS_TOKENS_LAST_USED,
+        CREATE_INDEX_ACTIVE_ACCESS_TOKENS_USERNAME,
+        Batched("""
+            UPDATE activeAccessTokens SET
+                issuedAt=COALESCE(CAST(strftime('%s', createdOn) AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER)),
+                lastUsedAt=COALESCE(CAST(strftime('%s', createdOn) AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER))
+            WHERE tokenID IN (SELECT tokenID FROM activeAccessTokens WHERE issuedAt IS NULL LIMIT :batchSize)
+        """),
+    ]),
+    (8, 'Covering indexes for /image/query', [
+        CREATE_INDEX_IMAGES_INBOX_PENDING,
+        CREATE_INDEX_IMAGES_INBOX_FINISHED,
+        CREATE_INDEX_IMAGE_HISTORY_INBOX,
+        """
+            DROP INDEX IF EXISTS imagesNextUserHopsLeft
+        """,
+        """
+            DROP INDEX IF EXISTS imageHistoryUsernameViewed
+        """,
+    ]),
+    # Only what's currently in someone's inbox is copied, which is far less than all images.
+    (9, 'Inbox table', [
+        """
+    CREATE TABLE IF NOT EXISTS inbox (
+        username TEXT NOT NULL,
+        imageUUID TEXT NOT NULL,
+        previousUser TEXT,
+        editTime INTEGER NOT NULL,
+        hopsLeft INTEGER NOT NULL,
+        PRIMARY KEY (username, imageUUID)
+    ) WITHOUT ROWID
+""",
+        CREATE_INDEX_INBOX_IMAGE,
+        """
+            INSERT INTO inbox (username, imageUUID, previousUser, editTime, hopsLeft)
+                SELECT nextUser, imageUUID, previousUser, editTime, hopsLeft FROM images
+                WHERE nextUser IS NOT NULL AND hopsLeft<>0
+                UNION ALL
+                SELECT imageHistory.username, images.imageUUID, images.previousUser, images.editTime, images.hopsLeft
+                FROM imageHistory JOIN images ON images.imageUUID=imageHistory.imageUUID
+                WHERE imageHistory.viewed=0 AND images.hopsLeft=0
+        """,
+        """
+            DROP INDEX IF EXISTS imagesInboxPending
+        """,
+        """
+            DROP INDEX IF EXISTS imagesInboxFinished
+        """,
+        """
+            DROP INDEX IF EXISTS imageHistoryInbox
+        """,
+    ]),
+    # The inbox is only ever derived from images and imageHistory, so it's simply rebuilt.
+    (10, 'Keep the inbox in a stable order', [
+        DROP_TABLE_INBOX,
+        CREATE_TABLE_INBOX,
+        CREATE_INDEX_INBOX_IMAGE,
+        """
+            INSERT INTO inbox (username, finished, imageID, imageUUID, previousUser, editTime, hopsLeft)
+                SELECT nextUser, 0, imageID, imageUUID, previousUser, editTime, hopsLeft FROM images
+                WHERE nextUser IS NOT NULL AND hopsLeft<>0
+                UNION ALL
+                SELECT imageHistory.username, 1, images.imageID, images.imageUUID, images.previousUser, images.editTime,
+                    images.hopsLeft
+                FROM imageHistory JOIN images ON images.imageUUID=imageHistory.imageUUID
+                WHERE imageHistory.viewed=0 AND images.hopsLeft=0
+        """,
+    ]),
+    # Blobs in the database bigger than a megabyte used to be one row, which could only be read back all at once. They're
+    # split into 64KB chunks (stored as is) one blob per batch, since each can be up to the biggest upload.
+    (11, 'Store big images in chunks', [
+        CREATE_TABLE_IMAGE_BLOB_CHUNKS,
+        CREATE_INDEX_IMAGE_BLOB_CHUNKS_SEQ,
+        Batched("""
+            INSERT INTO imageBlobChunks (blobID, seq, data)
+                WITH RECURSIVE
+                    blob AS (
+                        SELECT imageBlobs.blobID, imageBlobs.size, unpackImage(imageBlobData.data, imageBlobs.encoding) AS bytes
+                        FROM imageBlobs JOIN imageBlobData ON imageBlobData.blobID=imageBlobs.blobID
+                        WHERE imageBlobs.size>1048576 ORDER BY imageBlobs.blobID LIMIT 1
+                    ),
+                    chunks (seq) AS (
+                        SELECT 0 UNION ALL SELECT seq+1 FROM chunks WHERE (seq+1)*65536<(SELECT size FROM blob)
+                    )
+                SELECT blob.blobID, chunks.seq, substr(blob.bytes, chunks.seq*65536+1, 65536) FROM blob, chunks
+        """, """
+            UPDATE imageBlobs SET encoding='chunks' WHERE blobID=(
+                SELECT MIN(blobID) FROM imageBlobChunks WHERE blobID IN (SELECT blobID FROM imageBlobData)
+            )
+        """, """
+            DELETE FROM imageBlobData WHERE blobID=(
+                SELECT MIN(blobID) FROM imageBlobChunks WHERE blobID IN (SELECT blobID FROM imageBlobData)
+            )
+        """),
+    ]),
+]
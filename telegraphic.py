@@ -1,12 +1,39 @@
+import base64
 import bottle
 from bottle import error, get, post, run, request
+import auth
+import binascii
 import database
+import imagestore
+import json
+import os
+import uploads
 import uuid
 import time
+import types
 
 readyForRequests = False
 timeStarted = time.time()
 
+# An image's bytes never change once it's out of hops, so clients can keep those for good. Until then they have to check
+# back each time, which costs a 304 if it hasn't changed. Either way they're private since they need an access token.
+FINISHED_IMAGE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+PENDING_IMAGE_CACHE_CONTROL = 'private, no-cache'
+
+# Rows are read from the database, and written out to the client, this many at a time when streaming a list response.
+FETCH_SIZE = 256
+
+# List endpoints return this many items per page unless the client asks for fewer (or more, up to MAX_PAGE_SIZE). Each
+# page says where the next one starts with an opaque cursor.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# Behind a reverse proxy, image files can be left for it to send: set this to 'X-Accel-Redirect' for nginx (with an
+# internal location serving imagestore.BLOB_DIR at DOWNLOAD_OFFLOAD_LOCATION) or 'X-Sendfile' for Apache and lighttpd.
+# None sends them from here.
+DOWNLOAD_OFFLOAD = None
+DOWNLOAD_OFFLOAD_LOCATION = '/blobs/'
+
 
 def log(msg):
     global timeStarted
@@ -43,6 +70,12 @@ def success(msg):
     return {'success': True, 'message': msg}
 
 
+def reject(status, msg):
+    """Returns a failure JSON to the user along with an HTTP error status."""
+    bottle.response.status = status
+    return fail(msg)
+
+
 def checkReady():
     if not readyForRequests:
         log('Not ready...')
@@ -53,88 +86,294 @@ def checkReady():
 # #
 # Helper functions
 # #
-def jsonRow(cursor):
-    """Takes the next row from the cursor and formats it as a dictionary (JSON object as far as Bottle is concerned)."""
-    fields = [f[0] for f in cursor.description]
-
-    r = cursor.fetchone()
-    if r is not None:
-        i = 0
-        newDict = {}
-        for f in fields:
-            newDict[f] = r[i]
-            i += 1
-        return newDict
-    else:
-        return None
-
-
-def jsonRows(cursor):
-    """Queries a cursor and returns its rows as a JSON response (a list of dictionaries contained in a JSON object)."""
-    responseDict = {'success': 'true', 'items': []}
-
-    if cursor is None:
-        return responseDict
-
-    jr = jsonRow(cursor)
+def iterRows(cursor, fields, columnar=False):
+    """Yields a cursor's rows as it reads them, FETCH_SIZE at a time: as dictionaries, or as lists with columnar."""
+    if not fields:
+        return
+    while True:
+        batch = cursor.fetchmany(FETCH_SIZE)
+        if not batch:
+            return
+        for r in batch:
+            yield list(r) if columnar else dict(zip(fields, r))
+
+
+def jsonRows(cursor, columnar=False):
+    """Returns a cursor's rows as a JSON response (a list of dictionaries contained in a JSON object). With columnar, the
+    field names are only listed once, under "columns", and each row is a list of values in that order, under "rows".
+
+    The rows aren't read yet: they're a generator, which streamJSON reads from as it writes the response out, after the
+    handler has returned (see ContextPlugin)."""
+    fields = [f[0] for f in cursor.description] if cursor is not None and cursor.description is not None else []
+    rows = iterRows(cursor, fields, columnar)
+    if columnar:
+        return {'success': 'true', 'columns': fields, 'rows': rows}
+    return {'success': 'true', 'items': rows}
+
+
+def wantsColumnar(params):
+    """Whether a client asked for a list in the columnar format (see jsonRows)."""
+    return params is not None and params.get('format') == 'columnar'
+
+
+def pageRequest(params, keyLength):
+    """Reads the page size and cursor a client sent (the cursor decoded into the list of keyLength values it was made
+    from). Returns (page size, cursor), or raises ValueError if either isn't valid."""
+    limit = params.get('limit', DEFAULT_PAGE_SIZE)
+    if not isinstance(limit, int) or isinstance(limit, bool) or not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError('Invalid limit, should be between 1 and ' + str(MAX_PAGE_SIZE) + '.')
+
+    cursor = params.get('cursor')
+    if cursor is not None:
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+        except (binascii.Error, TypeError, ValueError):
+            raise ValueError('Invalid cursor.')
+        if not isinstance(cursor, list) or len(cursor) != keyLength or not all(
+                isinstance(v, (int, str)) and not isinstance(v, bool) for v in cursor):
+            raise ValueError('Invalid cursor.')
+    return limit, cursor
+
+
+def paginate(res, limit, key):
+    """Trims a response from jsonRows, whose query asked for limit + 1 rows, down to a page of limit items. Adds the
+    cursor for the next page (made from key(last item on this page, as a dictionary)), or None if this is the last
+    page. That's only known once the rows have been read, so nextCursor is a function streamJSON calls after them."""
+    field = 'items' if 'items' in res else 'rows'
+    rows = res[field]
+    page = {'last': None, 'more': False}
+
+    def trimmed():
+        for i, row in enumerate(rows):
+            if i == limit:
+                page['more'] = True
+                return
+            page['last'] = row
+            yield row
+
+    def nextCursor():
+        if not page['more']:
+            return None
+        last = page['last'] if field == 'items' else dict(zip(res['columns'], page['last']))
+        return base64.urlsafe_b64encode(json.dumps(key(last)).encode('utf-8')).decode('ascii')
+
+    res[field] = trimmed()
+    res['nextCursor'] = nextCursor
+    return res
 
-    while jr is not None:
-        responseDict['items'].append(jr)
-        jr = jsonRow(cursor)
 
-    return responseDict
+def isStreamed(rv):
+    """Whether a handler returned a response with a generator in it, which has to be written out with streamJSON."""
+    return isinstance(rv, dict) and any(isinstance(v, types.GeneratorType) for v in rv.values())
+
+
+def streamJSON(rv):
+    """Yields a response dictionary encoded as JSON a piece at a time. Each generator in it is written out as a list,
+    FETCH_SIZE items per piece, as it produces them, rather than the whole thing being built up in memory first. Each
+    function in it is called for its value when it's reached, so it can depend on what the generators before it
+    produced."""
+    pieces = ['{']
+    for i, (k, v) in enumerate(rv.items()):
+        pieces.append((', ' if i else '') + json.dumps(k) + ': ')
+        if callable(v):
+            v = v()
+        if not isinstance(v, types.GeneratorType):
+            pieces.append(json.dumps(v))
+            continue
+
+        pieces.append('[')
+        for j, item in enumerate(v):
+            pieces.append((', ' if j else '') + json.dumps(item))
+            if len(pieces) >= FETCH_SIZE:
+                yield ''.join(pieces).encode('utf-8')
+                pieces = []
+        pieces.append(']')
+    pieces.append('}')
+    yield ''.join(pieces).encode('utf-8')
+
+
+def streamResponse(rv, con):
+    """Writes out a streamed response (see streamJSON), then hands con, which its generators are reading from, back to
+    the pool. It's rolled back instead if the response fails partway or the client goes away."""
+    try:
+        for piece in streamJSON(rv):
+            yield piece
+    except:
+        if con is not None:
+            database.rollback(con)
+        raise
+    if con is not None:
+        database.close(con)
 
 
 # #
 # Access token functions
 # #
 
-def checkAccessToken():
-    """Make sure a certain access token is still valid and can be used to manipulate pictures."""
+def tokenFromHeader():
+    """Returns the access token from an "Authorization: Bearer" header, or None if the request didn't send one."""
+    header = request.get_header('Authorization', '')
+    if header[:7].lower() != 'bearer ':
+        return None
+    return header[7:].strip()
 
-    if not 'accessToken' in request.json.keys():
-        return False
 
-    con = database.connect()
-    c = con.cursor()
-    c.execute("SELECT COUNT(*) FROM activeAccessTokens WHERE accessToken=:accessToken",
-              {'accessToken': request.json['accessToken']})
+def requestAccessToken(body=None):
+    """Finds the access token sent with this request, preferring the Authorization header (which can be checked without
+    reading the request body) over the accessToken field in the JSON body. Pass body if it's already been parsed."""
+    token = tokenFromHeader()
+    if token is not None:
+        return token
 
-    r = c.fetchone()
+    if body is None:
+        body = request.json
+    if body is None or not 'accessToken' in body.keys():
+        return None
+    return body['accessToken']
 
-    if r[0] == 0:
-        return False
-    return True
 
+def accessTokenToUser(con=None, body=None):
+    """Look up the access token sent with this request and find out who the user is. Returns None if there's no valid
+    token."""
 
-def accessTokenToUser(token):
-    """Look up an access token and find out who the user is."""
+    token = requestAccessToken(body)
+    if token is None:
+        return None
 
     print("\tLooking up user: " + token + "... "),
 
-    con = database.connect()
-    c = con.cursor()
-    c.execute("SELECT username FROM activeAccessTokens WHERE accessToken=:accessToken", {'accessToken': token})
-
-    r = c.fetchone()
-    v = r[0]
-    print('It\'s ' + v)
-    database.close(con)
+    v = auth.lookupToken(token, con)
+    print('It\'s ' + str(v))
 
     return v
 
 
+# #
+# Request context
+# #
+
+class ContextPlugin(object):
+    """Does what every API call needs before its handler can run, so the handlers don't have to.
+
+    Handlers that take a `user` argument can only be called with a valid access token, and get passed the username it
+    belongs to. Handlers that take a `con` argument get one database connection for the whole request; whatever they do
+    with it is committed when they return, or rolled back if they raise. Either way the API has to be ready for
+    requests first. A handler can return a response with generators in it (see jsonRows), which is written out with
+    streamJSON; its connection is committed before that starts, but only handed back once it's finished.
+
+    Handlers that take a `body` argument get the request's body parsed as it's read, with any image in it kept in a
+    temporary file (see uploads.parseBody), instead of using request.json. That way they can take an image as JSON,
+    multipart/form-data or raw bytes alike.
+
+    Nothing here reads the request body unless the access token has to come from it. So a client that sends its token
+    in an Authorization header (along with "Expect: 100-continue") can be turned away, by a WSGI server that only sends
+    the 100 Continue once the body is read, before it has uploaded anything."""
+
+    name = 'context'
+    api = 2
+
+    def apply(self, callback, route):
+        args = route.get_callback_args()
+        wantsUser = 'user' in args
+        wantsCon = 'con' in args
+        wantsBody = 'body' in args
+
+        if not wantsUser and not wantsCon and not wantsBody:
+            return callback
+
+        def wrapper(*a, **ka):
+            if not checkReady():
+                return fail('The API is still booting up... Please wait.')
+
+            expect = request.get_header('Expect')
+            if expect is not None and expect.lower() != '100-continue':
+                return reject(417, 'Unsupported expectation.')
+            if request.content_length > bottle.BaseRequest.MEMFILE_MAX:
+                sublog('Request too large.')
+                return reject(413, 'Request too large.')
+
+            con = database.connect() if wantsCon else None
+            body = None
+            try:
+                # If the token isn't in a header the body has to be read to find it, otherwise leave that until it's
+                # been checked.
+                if wantsBody and tokenFromHeader() is None:
+                    body = uploads.parseBody(request, bottle.BaseRequest.MEMFILE_MAX)
+                if wantsUser:
+                    ka['user'] = accessTokenToUser(con, body)
+                    if ka['user'] is None:
+                        sublog('Bad access token.')
+                        if tokenFromHeader() is not None:
+                            bottle.response.set_header('WWW-Authenticate', 'Bearer')
+                            rv = reject(401, 'Invalid access token.')
+                        else:
+                            rv = fail('Invalid access token.')
+                        if con is not None:
+                            database.close(con)
+                        return rv
+                    if con is not None and con.in_transaction:
+                        # Touching the token takes the write lock; don't keep it while the handler does anything slow
+                        # before it writes (see imagestore.stageImage).
+                        con.commit()
+                if wantsBody:
+                    if body is None:
+                        body = uploads.parseBody(request, bottle.BaseRequest.MEMFILE_MAX)
+                    ka['body'] = body
+                if wantsCon:
+                    ka['con'] = con
+
+                rv = callback(*a, **ka)
+            except uploads.BadBody as e:
+                if con is not None:
+                    database.rollback(con)
+                sublog(str(e))
+                return reject(e.status, str(e))
+            except bottle.HTTPError:
+                if con is not None:
+                    database.rollback(con)
+                raise
+            except bottle.HTTPResponse:
+                if con is not None:
+                    database.close(con)
+                raise
+            except:
+                if con is not None:
+                    database.rollback(con)
+                raise
+            finally:
+                if body is not None:
+                    uploads.discard(body)
+
+            # The connection stays checked out until a streamed response has been written out, since that's when its
+            # rows are actually read. Anything the request wrote (even just auth touching the access token) is committed
+            # first though, so a slow client only ever holds up a read snapshot, never the write lock.
+            if isStreamed(rv):
+                if con is not None:
+                    try:
+                        con.commit()
+                    except:
+                        database.rollback(con)
+                        raise
+                bottle.response.content_type = 'application/json'
+                return streamResponse(rv, con)
+            if con is not None:
+                database.close(con)
+            return rv
+
+        return wrapper
+
+
+bottle.install(ContextPlugin())
+
+
 # ######################################################################################################################
 # User Accounts
 # ######################################################################################################################
 
 @post('/user/register')
-def userRegister():
+def userRegister(con):
     """Register a user."""
 
-    if not checkReady():
-        return fail('The API is still booting up... Please wait.')
-
     log('Attempting to register...')
 
     if not 'username' in request.json.keys():
@@ -156,7 +395,6 @@ def userRegister():
            request.json['passwordHash'])
 
     # Check that this user doesn't already exist.
-    con = database.connect()
     c = con.cursor()
     c.execute("SELECT COUNT(*) FROM users WHERE username=:username OR phoneNumber=:phoneNumber",
               {'username': request.json['username'], 'phoneNumber': request.json['phoneNumber']})
@@ -171,19 +409,14 @@ def userRegister():
               {'username': request.json['username'], 'passwordHash': request.json['passwordHash'],
                'phoneNumber': request.json['phoneNumber']})
 
-    database.close(con)
-
     sublog("User registered.")
     return success('User registered.')
 
 
 @post('/user/login')
-def userLogin():
+def userLogin(con):
     """Log a user in and generate a unique ID for this session."""
 
-    if not checkReady():
-        return fail('The API is still booting up... Please wait.')
-
     log('Logging in...')
     if not 'username' in request.json.keys():
         sublog('No username provided in request.')
@@ -195,7 +428,6 @@ def userLogin():
     sublog('Name: ' + request.json['username'] + '\n\tHash: ' + request.json['passwordHash'])
 
     # Check if this is the correct password.
-    con = database.connect()
     c = con.cursor()
     c.execute("SELECT COUNT(*) FROM users WHERE username=:username AND passwordHash=:passwordHash",
               {'username': request.json['username'], 'passwordHash': request.json['passwordHash']})
@@ -206,53 +438,65 @@ def userLogin():
         return fail('Invalid username or password.')
 
     # Alright, they've logged in, now generate a random access key and give it to them.
-    # XXX: These probably won't collide.
-    accessToken = str(uuid.uuid1())
-
-    c.execute("INSERT INTO activeAccessTokens (accessToken, username) VALUES (:accessToken, :username)",
-              {'accessToken': accessToken, 'username': request.json['username']})
-    database.close(con)
+    accessToken = auth.issueToken(c, request.json['username'])
 
     sublog('Login success.')
     return {'success': True, 'accessToken': accessToken, 'message': 'Logged in.'}
 
 
+@post('/user/logout')
+def userLogout(user, con):
+    """Revoke the access token used to make this request."""
+
+    log('Logging out...')
+    sublog('Name: ' + user)
+
+    c = con.cursor()
+    if not auth.revokeToken(c, requestAccessToken()):
+        sublog('Signed token, can\'t be revoked.')
+        return fail('This access token can\'t be revoked; it keeps working until it expires, so just forget it.')
+
+    sublog('Logged out.')
+    return success('Logged out.')
+
+
 @post('/user/list')
-def userListWithoutMe():
+def userListWithoutMe(user, con):
     """Return a list of users in the database so others can send images to them. Doesn't include yourself. User
     specify a search string to narrow down potential users and provide auto-complete functionality."""
 
-    if not checkReady():
-        return fail('The API is still booting up... Please wait.')
-
     log('Getting user list (exclusive)...')
+    sublog('Name: ' + user)
 
-    if not 'accessToken' in request.json.keys():
-        sublog('No access token.')
-        return fail('No access token in request.')
+    params = request.json or {}
+    try:
+        limit, cursor = pageRequest(params, 2 if 'search' in params else 1)
+    except ValueError as e:
+        sublog(str(e))
+        return fail(str(e))
 
-    thisUser = accessTokenToUser(request.json['accessToken'])
-    sublog('Name: ' + thisUser)
-
-    con = database.connect()
     c = con.cursor()
 
-    if not 'search' in request.json.keys():
-        sublog('Returning up to 100 non-specific users...')
-        c.execute("SELECT username FROM users WHERE username<>:username LIMIT 100", {'username': thisUser})
+    # Pages pick up after the last user on the one before: by username, or by (length, username) when searching.
+    if not 'search' in params:
+        sublog('Returning up to ' + str(limit) + ' non-specific users...')
+        c.execute(
+            "SELECT username FROM users WHERE username<>:username AND username>:after ORDER BY username LIMIT :limit",
+            {'username': user, 'after': cursor[0] if cursor else '', 'limit': limit + 1})
+        key = lambda item: [item['username']]
     else:
-        if len(request.json['search']) < 2:
+        if len(params['search']) < 2:
             sublog('Search string specified but not long enough.')
-            database.close(con)
             return fail('Search string not long enough, need at least 2 characters.')
 
-        sublog('Returning up to 100 users that begin with ' + str(request.json['search']))
+        sublog('Returning up to ' + str(limit) + ' users that begin with ' + str(params['search']))
         c.execute(
-            "SELECT username FROM users WHERE username<>:username AND username LIKE :search ORDER BY length(username) ASC LIMIT 100",
-            {'username': thisUser, 'search': request.json['search'] + '%'})
+            "SELECT username FROM users WHERE username<>:username AND username LIKE :search AND (length(username), username)>(:afterLength, :after) ORDER BY length(username) ASC, username ASC LIMIT :limit",
+            {'username': user, 'search': params['search'] + '%', 'afterLength': cursor[0] if cursor else 0,
+             'after': cursor[1] if cursor else '', 'limit': limit + 1})
+        key = lambda item: [len(item['username']), item['username']]
 
-    res = jsonRows(c)
-    database.close(con)
+    res = paginate(jsonRows(c, wantsColumnar(params)), limit, key)
     sublog('Ok.')
 
     return res
@@ -262,128 +506,137 @@ def userListWithoutMe():
 # Image Handling
 # ######################################################################################################################
 
+def refreshInbox(c, imageUUID):
+    """Rewrites an image's entries in everyone's inbox to match the image and its history. Call this whenever either
+    changes, in the same transaction."""
+    c.execute("DELETE FROM inbox WHERE imageUUID=:imageUUID", {'imageUUID': imageUUID})
+    c.execute(
+        """INSERT INTO inbox (username, finished, imageID, imageUUID, previousUser, editTime, hopsLeft)
+            SELECT nextUser, 0, imageID, imageUUID, previousUser, editTime, hopsLeft FROM images
+            WHERE imageUUID=:imageUUID AND nextUser IS NOT NULL AND hopsLeft<>0
+            UNION ALL
+            SELECT imageHistory.username, 1, images.imageID, images.imageUUID, images.previousUser, images.editTime,
+                images.hopsLeft
+            FROM imageHistory JOIN images ON images.imageUUID=imageHistory.imageUUID
+            WHERE imageHistory.imageUUID=:imageUUID AND imageHistory.viewed=0 AND images.hopsLeft=0""",
+        {'imageUUID': imageUUID})
+
+
 @post('/image/create')
-def imageCreate():
+def imageCreate(user, con, body):
     """Create an initial image."""
 
-    if not checkReady():
-        return fail('The API is still booting up... Please wait.')
-
     log('Creating the first image...')
 
-    if not checkAccessToken():
-        sublog('No access token.')
-        return fail('Invalid access token.')
-    if not 'editTime' in request.json.keys():
+    if not 'editTime' in body.keys():
         sublog('No editTime specified.')
         return fail('No editTime specified.')
-    if not 'hopsLeft' in request.json.keys():
+    if not 'hopsLeft' in body.keys():
         sublog('No hopsLeft specified.')
         return fail('No hopsLeft specified.')
-    if not 'nextUser' in request.json.keys():
+    if not 'nextUser' in body.keys():
         sublog('No nextUser specified.')
         return fail('No nextUser specified.')
-    if not 'image' in request.json.keys():
+    if not 'image' in body.keys():
         sublog('No image specified.')
         return fail('No image specified.')
 
-    sublog('Edit time: ' + str(request.json['editTime']) + '\n\tHops: ' + str(
-        request.json['hopsLeft']) + '\n\tNext user: ' + request.json['nextUser'] + '\n\tImage: (yes)')
+    sublog('Edit time: ' + str(body['editTime']) + '\n\tHops: ' + str(
+        body['hopsLeft']) + '\n\tNext user: ' + body['nextUser'] + '\n\tImage: (yes)')
+
+    if body['image'] is None:
+        sublog('Image was not valid base64.')
+        return fail('Image is not valid base64.')
 
     # Make sure the next user is valid...
-    con = database.connect()
     c = con.cursor()
-    c.execute("SELECT COUNT(*) FROM users WHERE username=:nextUser", {'nextUser': request.json['nextUser']})
+    c.execute("SELECT COUNT(*) FROM users WHERE username=:nextUser", {'nextUser': body['nextUser']})
 
     r = c.fetchone()
     if r[0] == 0:
-        database.close(con)
         sublog('Next user was not valid.')
         return fail('Invalid nextUser.')
+    staged = imagestore.stageImage(c, body['image'])
 
     # Add the image to the pending queue.
-    thisUser = accessTokenToUser(request.json['accessToken'])
     thisImageUUID = str(uuid.uuid1())
 
-    sublog('Name: ' + thisUser)
+    sublog('Name: ' + user)
 
     c.execute(
-        "INSERT INTO images (imageUUID, originalOwner, hopsLeft, editTime, image, nextUser, previousUser) VALUES (:imageUUID, :originalOwner, :hopsLeft, :editTime, :image, :nextUser, :previousUser)",
-        {'imageUUID': thisImageUUID, 'originalOwner': thisUser,
-         'hopsLeft': request.json['hopsLeft'], 'editTime': request.json['editTime'], 'image': request.json['image'],
-         'nextUser': request.json['nextUser'], 'previousUser': thisUser})
+        "INSERT INTO images (imageUUID, originalOwner, hopsLeft, editTime, image, nextUser, previousUser) VALUES (:imageUUID, :originalOwner, :hopsLeft, :editTime, x'', :nextUser, :previousUser)",
+        {'imageUUID': thisImageUUID, 'originalOwner': user,
+         'hopsLeft': body['hopsLeft'], 'editTime': body['editTime'],
+         'nextUser': body['nextUser'], 'previousUser': user})
+    imagestore.saveImage(c, c.lastrowid, staged, user)
 
     # Add the initial creator into the log of people who should be notified when this image is done.
     c.execute("INSERT INTO imageHistory (imageUUID, username) VALUES (:imageUUID, :username)",
-              {'imageUUID': thisImageUUID, 'username': thisUser})
+              {'imageUUID': thisImageUUID, 'username': user})
+    refreshInbox(c, thisImageUUID)
 
     # TODO: Send push notification to the next user.
 
-    database.close(con)
     sublog('Image created.')
 
     return success('Image created and next user will be alerted.')
 
 
 @post('/image/update')
-def imageUpdate():
+def imageUpdate(user, con, body):
     """Update an existing image, and decrement its number of hops. If it reaches the end of its life, add it to the
     list of pending images that people need to see (and send push notifications)."""
 
-    if not checkReady():
-        return fail('The API is still booting up... Please wait.')
-
     log('Updating an image...')
-    if not checkAccessToken():
-        sublog('Bad access token.')
-        return fail('Invalid access token.')
-    if not 'nextUser' in request.json.keys():
+    if not 'nextUser' in body.keys():
         sublog('No nextUser.')
         return fail('No nextUser specified.')
-    if not 'image' in request.json.keys():
+    if not 'image' in body.keys():
         log('No image.')
         return fail('No image specified.')
-    if not 'uuid' in request.json.keys():
+    if not 'uuid' in body.keys():
         log('No uuid.')
         return fail('No UUID specified.')
 
-    # Check that this image has this user specified as its next user (aka that we have permission to edit this image).
-    thisUser = accessTokenToUser(request.json['accessToken'])
-    sublog('Name: ' + thisUser)
+    if body['image'] is None:
+        sublog('Image was not valid base64.')
+        return fail('Image is not valid base64.')
+
+    # Check that this image has this user specified as its next user (aka that we have permission to edit this image),
+    # and that it has hops left. Once it's out of hops it's finished and never changes again, which the image cache and
+    # the Cache-Control on /image/data count on.
+    sublog('Name: ' + user)
 
-    con = database.connect()
     c = con.cursor()
-    c.execute("SELECT COUNT(*) FROM images WHERE imageUUID=:imageUUID AND nextUser=:nextUser",
-              {'imageUUID': request.json['uuid'], 'nextUser': thisUser})
+    c.execute("SELECT imageID, hopsLeft FROM images WHERE imageUUID=:imageUUID AND nextUser=:nextUser AND hopsLeft>0",
+              {'imageUUID': body['uuid'], 'nextUser': user})
 
     r = c.fetchone()
 
-    if r[0] == 0:
+    if r is None:
         sublog('Not allowed to update this image, or the image does not exist.')
         return fail('Not the next user, or this image does not exist.')
+    staged = imagestore.stageImage(c, body['image'])
 
     # Decrement its hop count and update its next user. If hop count is 0, set next user to null.
-    c.execute("SELECT hopsLeft FROM images WHERE imageUUID=:imageUUID", {'imageUUID': request.json['uuid']})
-    r = c.fetchone()
-    newHopsLeft = r[0] - 1
+    imageID = r[0]
+    newHopsLeft = r[1] - 1
 
     # Also, update the actual image...
     c.execute(
-        "UPDATE images SET hopsLeft=:hopsLeft, image=:image, previousUser=:previousUser, nextUser=:nextUser WHERE imageUUID=:imageUUID",
-        {'hopsLeft': newHopsLeft, 'image': request.json['image'], 'imageUUID': request.json['uuid'],
-         'previousUser': thisUser, 'nextUser': request.json['nextUser']})
+        "UPDATE images SET hopsLeft=:hopsLeft, previousUser=:previousUser, nextUser=:nextUser WHERE imageUUID=:imageUUID",
+        {'hopsLeft': newHopsLeft, 'imageUUID': body['uuid'], 'previousUser': user,
+         'nextUser': body['nextUser']})
+    imagestore.saveImage(c, imageID, staged, user)
+    imagestore.imageCache.invalidate(body['uuid'])
 
     # Add this user to the affected user list who need to see the final image... but only if they're not already named
     # by this image (to prevent repeats from sending it between the same people).
-    c.execute("SELECT COUNT(*) FROM imageHistory WHERE imageUUID=:imageUUID AND username=:username",
-              {'imageUUID': request.json['uuid'], 'username': thisUser})
-    r = c.fetchone()
-
-    if r[0] == 0:
-        c.execute("INSERT INTO imageHistory (imageUUID, username) VALUES (:imageUUID, :username)",
-                  {'imageUUID': request.json['uuid'], 'username': thisUser})
+    c.execute("INSERT OR IGNORE INTO imageHistory (imageUUID, username) VALUES (:imageUUID, :username)",
+              {'imageUUID': body['uuid'], 'username': user})
+    refreshInbox(c, body['uuid'])
 
-    sublog('Next user: ' + request.json['nextUser'] + '\n\tHops left: ' + str(newHopsLeft))
+    sublog('Next user: ' + body['nextUser'] + '\n\tHops left: ' + str(newHopsLeft))
 
     # Check if this is the final hop and if so, alert all users.
     if newHopsLeft == 0:
@@ -393,126 +646,257 @@ def imageUpdate():
         sublog('Image updated, notifying next user.')
         # TODO: Push notify nextUser
 
-    database.close(con)
     return success('Image passed along to the next user!')
 
 
 @post('/image/query')
-def imageQuery():
+def imageQuery(user, con):
     """Returns a list of images that a user should see. Some might be incomplete, needing additions, and others might be
      finished images."""
 
-    if not checkReady():
-        return fail('The API is still booting up... Please wait.')
-
     log('Querying for list of actionable images...')
 
-    if not checkAccessToken():
-        sublog('Bad access token.')
-        return fail('Invalid access token.')
+    sublog('Name: ' + user)
 
-    thisUser = accessTokenToUser(request.json['accessToken'])
-    sublog('Name: ' + thisUser)
+    try:
+        limit, cursor = pageRequest(request.json or {}, 2)
+    except ValueError as e:
+        sublog(str(e))
+        return fail(str(e))
 
-    # Basically, look at the images table and see if any have nextUser set to us. This will be the first set of results.
-    # Also look for images in the images table whose hopCount is 0 and with us in the history table linking us to this image.
-    con = database.connect()
+    # Everything that's waiting for us to draw on it, and every finished image we worked on but haven't seen yet, is
+    # kept in our inbox (see refreshInbox), waiting ones first and each oldest first. Pages pick up after the last image
+    # on the one before, by (whether it's finished, its imageUUID).
     c = con.cursor()
-
-    # We need the rows from this and also anything that this username has in the image history which hasn't 0 hopCount.
-    c.execute(
-        "SELECT imageUUID, previousUser, editTime, hopsLeft FROM images WHERE nextUser=:thisUser AND hopsLeft<>0",
-        {'thisUser': thisUser})
-
-    firstSet = jsonRows(c)['items']
-
-    # Now, we also need any image whose UUID is mentioned with this username in the imageHistory, and whose hopCount is 0
     c.execute(
-        "SELECT imageUUID, previousUser, editTime, hopsLeft FROM images AS III WHERE III.imageUUID IN (SELECT imageUUID FROM imageHistory WHERE username=:username AND viewed=0) AND hopsLeft=0",
-        {'username': thisUser})
-
-    secondSet = jsonRows(c)['items']
+        "SELECT imageUUID, previousUser, editTime, hopsLeft FROM inbox WHERE username=:username AND (finished, imageID)>(:afterFinished, COALESCE((SELECT imageID FROM images WHERE imageUUID=:after), 0)) ORDER BY finished, imageID LIMIT :limit",
+        {'username': user, 'afterFinished': cursor[0] if cursor else -1, 'after': cursor[1] if cursor else '',
+         'limit': limit + 1})
 
-    database.close(con)
+    res = paginate(jsonRows(c, wantsColumnar(request.json)), limit,
+                   lambda item: [1 if item['hopsLeft'] == 0 else 0, item['imageUUID']])
 
-    sublog("Unfinished images: " + str(len(firstSet)))
-    sublog("Finished images: " + str(len(secondSet)))
-
-    finalSet = []
-    for thing in firstSet:
-        finalSet.append(thing)
-    for thing in secondSet:
-        finalSet.append(thing)
-
-    return {'success': True, 'items': finalSet}
+    res['success'] = True
+    return res
 
 
 @post('/image/fetch')
-def imageFetch():
+def imageFetch(user, con):
     """Returns the actual image data based on an imageUUID if the user can see it."""
 
-    if not checkReady():
-        return fail('The API is still booting up... Please wait.')
-
     log('Fetching actual image data...')
 
-    if not checkAccessToken():
-        sublog('Bad access token.')
-        return fail('Invalid access token.')
-    if not 'uuid' in request.json.keys():
+    params = request.json or {}
+    if not 'uuid' in params:
         sublog('No image ID specified for fetch.')
         return fail('No image ID specified for fetch.')
 
-    thisUser = accessTokenToUser(request.json['accessToken'])
-    sublog('Name: ' + thisUser)
+    sublog('Name: ' + user)
+
+    # Finished images are usually fetched by everyone who worked on them, so they're kept in memory.
+    cached = imagestore.imageCache.get(params['uuid'])
+    if cached is not None:
+        sublog('Cached.')
+        return {'success': True, 'image': imagestore.encodeDownload(cached[1])}
 
     # Since presumably if the user has a UUID, it knows the image exists and it must somehow be authorized to see it
     # (probably), so just give in and return it, unless the hop count is -1.
-    con = database.connect()
     c = con.cursor()
-    c.execute("SELECT image FROM images WHERE imageUUID=:imageUUID AND hopCount>=0",
-              {'imageUUID': request.json['uuid']})
+    info = imagestore.imageInfo(c, params['uuid'])
 
-    r = c.fetchone()
+    if info is None:
+        sublog('No rows...')
+        return fail('No image by that UUID.')
+
+    # Big images are sent as they're read instead.
+    contentHash, size, hopsLeft, encoding = info
+    if size >= imagestore.STREAM_MIN_SIZE:
+        sublog('Streaming ' + str(size) + ' bytes.')
+        bottle.response.content_type = 'application/json'
+        return streamImageJSON(imageChunks(contentHash, encoding))
 
-    if len(r) == 0:
+    image = imagestore.loadBlob(c, contentHash)
+
+    if image is None:
         sublog('No rows...')
-        database.close(con)
         return fail('No image by that UUID.')
+    if hopsLeft == 0:
+        imagestore.imageCache.put(params['uuid'], contentHash, image)
 
-    arr = {'success': True, 'image': r[0]}
-    database.close(con)
+    arr = {'success': True, 'image': imagestore.encodeDownload(image)}
 
     return arr
 
 
+def streamBlob(contentHash, offset=0, length=None):
+    """Yields length bytes (or the rest) of an image stored in chunks in the database, starting at offset, a chunk at a
+    time. Each chunk is read with a connection checked out just for that, so a slow download never keeps a connection
+    (or a snapshot that stops the log being checkpointed) to itself. If the image is garbage collected part of the way
+    through, the rest of it just never comes."""
+    seq, skip = divmod(offset, imagestore.BLOB_CHUNK_SIZE)
+    while length is None or length > 0:
+        con = database.connect()
+        try:
+            chunk = imagestore.blobChunk(con.cursor(), contentHash, seq)
+        finally:
+            database.rollback(con)
+        if chunk is None:
+            return
+        chunk = chunk[skip:] if length is None else chunk[skip:skip + length]
+        if length is not None:
+            length -= len(chunk)
+        yield chunk
+        seq, skip = seq + 1, 0
+
+
+def imageChunks(contentHash, encoding):
+    """Yields an image's bytes a chunk at a time, wherever it's stored."""
+    if encoding == imagestore.ENCODING_CHUNKS:
+        for chunk in streamBlob(contentHash):
+            yield chunk
+        return
+
+    if encoding != imagestore.ENCODING_FILE:
+        # Only chunked blobs are ever big enough for reading them all at once to matter.
+        con = database.connect()
+        try:
+            image = imagestore.loadBlob(con.cursor(), contentHash)
+        finally:
+            database.rollback(con)
+        if image is not None:
+            yield image
+        return
+
+    with open(imagestore.blobPath(contentHash), 'rb') as f:
+        while True:
+            chunk = f.read(imagestore.STREAM_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def streamImageJSON(chunks):
+    """Yields the same JSON /image/fetch sends for an image, encoding the image as it goes."""
+    yield b'{"success": true, "image": "'
+    for piece in imagestore.encodeDownloadChunks(chunks):
+        yield piece
+    yield b'"}'
+
+
+def etagMatches(header, etag):
+    """Checks whether an If-None-Match (or If-Range) header lists an ETag."""
+    if header is None:
+        return False
+    tags = [t.strip() for t in header.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
+
+@get('/image/data/<imageUUID>')
+def imageData(imageUUID, user, con):
+    """Returns the actual image data for an imageUUID as raw bytes rather than base64 JSON, so it can be cached. Handles
+    If-None-Match and Range requests."""
+
+    log('Fetching raw image data...')
+    sublog('Name: ' + user)
+
+    # Same rules as /image/fetch.
+    c = con.cursor()
+    info = imagestore.imageInfo(c, imageUUID)
+
+    if info is None:
+        sublog('No rows...')
+        return reject(404, 'No image by that UUID.')
+
+    contentHash, size, hopsLeft, encoding = info
+    etag = '"' + contentHash + '"'
+    headers = {'ETag': etag, 'Accept-Ranges': 'bytes',
+               'Cache-Control': FINISHED_IMAGE_CACHE_CONTROL if hopsLeft == 0 else PENDING_IMAGE_CACHE_CONTROL}
+
+    if etagMatches(request.get_header('If-None-Match'), etag):
+        sublog('Not modified.')
+        return bottle.HTTPResponse(status=304, **headers)
+
+    # A Range only applies if the client's partial copy is of this version (when it says which version it has).
+    ifRange = request.get_header('If-Range')
+    ranged = 'HTTP_RANGE' in request.environ and (ifRange is None or etagMatches(ifRange, etag))
+
+    # A big image in the database is streamed out as it's read (once this handler's connection is back in the pool).
+    if encoding == imagestore.ENCODING_CHUNKS:
+        image = None
+        headers['Content-Type'] = imagestore.mimeType(imagestore.peekBlob(c, contentHash))
+    else:
+        # Returning the file itself lets bottle hand it to wsgi.file_wrapper, so servers that can will sendfile it.
+        image = imagestore.openBlob(c, contentHash, encoding)
+        if image is None:
+            sublog('Image was just replaced.')
+            return reject(404, 'No image by that UUID.')
+        headers['Content-Type'] = imagestore.mimeType(image.read(16))
+
+    # Or better yet, have the proxy in front send it (Range requests included).
+    if DOWNLOAD_OFFLOAD is not None and encoding == imagestore.ENCODING_FILE:
+        image.close()
+        path = imagestore.blobPath(contentHash)
+        if DOWNLOAD_OFFLOAD == 'X-Accel-Redirect':
+            headers['X-Accel-Redirect'] = DOWNLOAD_OFFLOAD_LOCATION + os.path.relpath(path, imagestore.BLOB_DIR)
+        else:
+            headers[DOWNLOAD_OFFLOAD] = os.path.abspath(path)
+        sublog('Handed off to the proxy.')
+        return bottle.HTTPResponse(**headers)
+
+    headers['Content-Length'] = str(size)
+    if image is not None:
+        image.seek(0)
+
+    if ranged:
+        ranges = list(bottle.parse_range_header(request.environ['HTTP_RANGE'], size))
+        if not ranges:
+            sublog('Unsatisfiable range.')
+            if image is not None:
+                image.close()
+            headers['Content-Range'] = 'bytes */' + str(size)
+            del headers['Content-Type'], headers['Content-Length']
+            return bottle.HTTPResponse(status=416, **headers)
+        offset, end = ranges[0]
+        sublog('Range: ' + str(offset) + '-' + str(end - 1))
+        headers['Content-Range'] = 'bytes ' + str(offset) + '-' + str(end - 1) + '/' + str(size)
+        headers['Content-Length'] = str(end - offset)
+        if image is None:
+            return bottle.HTTPResponse(streamBlob(contentHash, offset, end - offset), status=206, **headers)
+        body = bottle._closeiter(bottle._file_iter_range(image, offset, end - offset), image.close)
+        return bottle.HTTPResponse(body, status=206, **headers)
+
+    if image is None:
+        sublog('Streaming ' + str(size) + ' bytes.')
+        return bottle.HTTPResponse(streamBlob(contentHash), **headers)
+    return bottle.HTTPResponse(image, **headers)
+
+
 @post('/image/seen')
-def imageSeen():
+def imageSeen(user, con):
     """Set an image's hop count to -1 so it won't appear in the list of images the client gets when they query."""
 
-    if not checkReady():
-        return fail('The API is still booting up... Please wait.')
-
     log('Marking image as seen...')
 
-    if not checkAccessToken():
-        sublog('Bad access token.')
-        return fail('Invalid access token.')
-    if not 'uuid' in request.json.keys():
+    params = request.json or {}
+    if not 'uuid' in params:
         sublog('No UUID specified.')
         return fail('No UUID specified.')
 
     # Make sure a client can only mark their own images as seen, and only images that have a hopCount of 0.
-    thisUser = accessTokenToUser(request.json['accessToken'])
-    sublog('Name: ' + thisUser)
+    sublog('Name: ' + user)
 
-    con = database.connect()
     c = con.cursor()
 
     c.execute("UPDATE imageHistory SET viewed=1 WHERE imageUUID=:imageUUID AND username=:username",
-              {'imageUUID': request.json['uuid'], 'username': thisUser})
+              {'imageUUID': params['uuid'], 'username': user})
+    c.execute("DELETE FROM inbox WHERE username=:username AND imageUUID=:imageUUID AND hopsLeft=0",
+              {'imageUUID': params['uuid'], 'username': user})
 
-    database.close(con)
+    # Once everyone has seen it there's no point keeping it in memory.
+    c.execute("SELECT COUNT(*) FROM imageHistory WHERE imageUUID=:imageUUID AND viewed=0",
+              {'imageUUID': params['uuid']})
+    if c.fetchone()[0] == 0:
+        imagestore.imageCache.invalidate(params['uuid'])
 
     sublog('Acknowledgement complete.')
     return success('Successfully acknowledged image.')
@@ -523,92 +907,64 @@ def imageSeen():
 # ######################################################################################################################
 
 @post('/friends')
-def getFriends():
+def getFriends(user, con):
     """Get the friends list of a client."""
 
-    if not checkReady():
-        return fail('The API is still booting up... Please wait.')
-
     log('Checking friends list...')
 
-    if not checkAccessToken():
-        sublog('Bad access token.')
-        return fail('Invalid access token.')
-
-    thisUser = accessTokenToUser(request.json['accessToken'])
-    sublog('Name: ' + thisUser)
+    sublog('Name: ' + user)
 
-    con = database.connect()
     c = con.cursor()
 
-    c.execute("SELECT friend FROM friends WHERE username=:username", {'username': thisUser})
+    c.execute("SELECT friend FROM friends WHERE username=:username", {'username': user})
 
-    res = jsonRows(c)
-    database.close(con)
+    res = jsonRows(c, wantsColumnar(request.json))
 
     sublog('Ok.')
     return res
 
 
 @post('/friends/add')
-def addFriend():
+def addFriend(user, con):
     """Adds a friend to someone's friend list."""
 
-    if not checkReady():
-        return fail('The API is still booting up... Please wait.')
-
     log('Adding friend...')
 
-    if not checkAccessToken():
-        sublog('Bad access token.')
-        return fail('Invalid access token.')
-    if not 'friend' in request.json.keys():
+    params = request.json or {}
+    if not 'friend' in params:
         sublog('No friend specified.')
         return fail('No friend specified.')
 
-    thisUser = accessTokenToUser(request.json['accessToken'])
-    sublog('Name: ' + thisUser + '\n\tFriend: ' + request.json['friend'])
+    sublog('Name: ' + user + '\n\tFriend: ' + params['friend'])
 
-    if request.json['friend'] == thisUser:
+    if params['friend'] == user:
         sublog('User tried to add themself as friend...')
         return fail('You can\'t add yourself as a friend...')
 
-    con = database.connect()
     c = con.cursor()
 
     c.execute("INSERT OR IGNORE INTO friends (username, friend) VALUES (:username, :friend)",
-              {'username': thisUser, 'friend': request.json['friend']})
-
-    database.close(con)
+              {'username': user, 'friend': params['friend']})
 
     sublog('Friend added.')
     return success('Friend added!')
 
 
 @post('/friends/delete')
-def deleteFriend():
-    if not checkReady():
-        return fail('The API is still booting up... Please wait.')
-
+def deleteFriend(user, con):
     log('Removing friend...')
 
-    if not checkAccessToken():
-        sublog('Bad access token.')
-        return fail('Invalid access token.')
-    if not 'friend' in request.json.keys():
+    params = request.json or {}
+    if not 'friend' in params:
         sublog('No friend specified.')
         return fail('No friend specified.')
 
-    thisUser = accessTokenToUser(request.json['accessToken'])
-    sublog('Name: ' + thisUser + '\n\tFriend: ' + request.json['friend'])
+    sublog('Name: ' + user + '\n\tFriend: ' + params['friend'])
 
-    con = database.connect()
     c = con.cursor()
 
     c.execute("DELETE FROM friends WHERE username=:username and friend=:friend",
-              {'username': thisUser, 'friend': request.json['friend']})
-
-    database.close(con)
+              {'username': user, 'friend': params['friend']})
 
     sublog('Friend removed.')
     return success('Friend removed!')
@@ -616,6 +972,10 @@ def deleteFriend():
 
 print("Creating tables if need be...")
 database.createTables()
+database.startCheckpointer()
+database.startBackgroundTask('collector', imagestore.GC_INTERVAL, imagestore.collectGarbage)
+database.startBackgroundTask('sweeper', imagestore.BLOB_SWEEP_INTERVAL, imagestore.sweepBlobFiles)
+database.startBackgroundTask('tokenPurge', auth.TOKEN_PURGE_INTERVAL, auth.purgeExpiredTokens)
 
 print("API starting...")
 bottle.BaseRequest.MEMFILE_MAX = 15000000  # The base64-encoded images can get pretty big; prevent JSON parse from fail.
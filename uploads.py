@@ -0,0 +1,341 @@
+import binascii
+import json
+import string
+import tempfile
+
+# Request bodies are read this many bytes at a time.
+READ_SIZE = 64 * 1024
+
+# Fields of a JSON body that hold a base64 image. They're decoded into a temporary file as the body is read, so neither
+# the base64 text nor the decoded image ever has to be held in memory all at once.
+STREAMED_FIELDS = ('image',)
+
+# Every other field is kept as an ordinary value, and no single one of those can be longer than this (in bytes of JSON).
+MAX_FIELD_SIZE = 64 * 1024
+
+# Decoded images smaller than this are kept in memory rather than written out to disk.
+SPOOL_SIZE = 1024 * 1024
+
+# Images can also be uploaded as they are rather than as base64, either as the whole request body or as the "image" part
+# of a multipart/form-data request. The other fields then come from these headers, or from a "metadata" part holding a
+# JSON object, respectively.
+METADATA_HEADERS = {
+    'editTime': 'X-Edit-Time',
+    'hopsLeft': 'X-Hops-Left',
+    'nextUser': 'X-Next-User',
+    'uuid': 'X-Image-UUID',
+}
+
+_BASE64_ALPHABET = (string.ascii_letters + string.digits + '+/=').encode('ascii')
+_NOT_BASE64 = bytes(b for b in range(256) if b not in _BASE64_ALPHABET)
+
+_ESCAPES = {b'"': b'"', b'\\': b'\\', b'/': b'/', b'b': b'\b', b'f': b'\f', b'n': b'\n', b'r': b'\r', b't': b'\t'}
+
+
+class BadBody(ValueError):
+    """Raised when a request body can't be parsed. status is the HTTP status to reject the request with."""
+    status = 400
+
+
+class BodyTooLarge(BadBody):
+    """Raised when a request body turns out to be bigger than it's allowed to be."""
+    status = 413
+
+
+class _Reader(object):
+    """Hands out a request body a byte or a run of bytes at a time, reading it in chunks as they're needed."""
+
+    def __init__(self, chunks, limit):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+        self._pos = 0
+        self._read = 0
+        self._limit = limit
+
+    def _fill(self):
+        # Returns False once the whole body has been used up.
+        while self._pos >= len(self._buffer):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return False
+            self._read += len(chunk)
+            if self._read > self._limit:
+                raise BodyTooLarge('Request too large.')
+            self._buffer, self._pos = chunk, 0
+        return True
+
+    def atEnd(self):
+        return not self._fill()
+
+    def peek(self):
+        if not self._fill():
+            raise BadBody('Request body ended unexpectedly.')
+        return self._buffer[self._pos:self._pos + 1]
+
+    def take(self):
+        c = self.peek()
+        self._pos += 1
+        return c
+
+    def expect(self, c):
+        self.skipSpace()
+        if self.take() != c:
+            raise BadBody('Request body is not a valid JSON object.')
+
+    def skipSpace(self):
+        while self._fill() and self._buffer[self._pos:self._pos + 1] in b' \t\r\n':
+            self._pos += 1
+
+    def takeRun(self):
+        """Returns the buffered bytes up to the next quote or backslash, which might be none at all."""
+        self.peek()
+        end = len(self._buffer)
+        for special in (b'"', b'\\'):
+            found = self._buffer.find(special, self._pos, end)
+            if found >= 0:
+                end = found
+        run = self._buffer[self._pos:end]
+        self._pos = end
+        return run
+
+
+class _Base64File(object):
+    """Decodes base64 text written to it a piece at a time into a file. Anything that isn't part of the base64 alphabet
+    (such as line breaks) is skipped, the same as the image used to be decoded all in one go."""
+
+    def __init__(self, out):
+        self.out = out
+        self.valid = True
+        self._pending = b''
+
+    def write(self, text):
+        if not self.valid:
+            return
+        text = self._pending + text.translate(None, _NOT_BASE64)
+        whole = len(text) - len(text) % 4
+        self._pending = text[whole:]
+        try:
+            self.out.write(binascii.a2b_base64(text[:whole]))
+        except binascii.Error:
+            self.valid = False
+
+    def finish(self):
+        """Returns the decoded file, rewound, or None (closing it) if the text wasn't valid base64."""
+        if self._pending:
+            self.valid = False
+        if not self.valid:
+            self.out.close()
+            return None
+        self.out.seek(0)
+        return self.out
+
+
+def _streamString(reader, out):
+    # The opening quote has already been taken.
+    while True:
+        run = reader.takeRun()
+        if run:
+            out.write(run)
+            continue
+        if reader.take() == b'"':
+            return
+        escape = reader.take()
+        if escape == b'u':
+            out.write(chr(int(b''.join(reader.take() for _ in range(4)), 16)).encode('utf-8'))
+        elif escape in _ESCAPES:
+            out.write(_ESCAPES[escape])
+        else:
+            raise BadBody('Request body is not a valid JSON object.')
+
+
+def _value(reader):
+    """Reads one JSON value of any kind (as long as it's small) and returns it decoded."""
+    reader.skipSpace()
+    raw = []
+    size = 0
+    depth = 0
+    inString = False
+    while True:
+        c = reader.peek()
+        if inString:
+            run = reader.takeRun()
+            if run:
+                raw.append(run)
+            else:
+                raw.append(reader.take())
+                if c == b'\\':
+                    raw.append(reader.take())
+                else:
+                    inString = False
+                    if depth == 0:
+                        break
+            size += max(len(run), 1)
+        elif c == b'"':
+            raw.append(reader.take())
+            inString = True
+        elif c in b'{[':
+            raw.append(reader.take())
+            depth += 1
+        elif c in b'}]' or c == b',':
+            if depth == 0:
+                break
+            raw.append(reader.take())
+            if c != b',':
+                depth -= 1
+                if depth == 0:
+                    break
+        else:
+            raw.append(reader.take())
+        size += 1
+
+        if size > MAX_FIELD_SIZE:
+            raise BodyTooLarge('Request field too large.')
+
+    return json.loads(b''.join(raw).decode('utf-8'))
+
+
+def _chunks(request):
+    read = request.environ['wsgi.input'].read
+    return request._iter_chunked(read, READ_SIZE) if request.chunked else request._iter_body(read, READ_SIZE)
+
+
+def _parseJSON(request, limit):
+    reader = _Reader(_chunks(request), limit)
+
+    body = {}
+    try:
+        reader.skipSpace()
+        if reader.atEnd():
+            return body
+
+        reader.expect(b'{')
+        reader.skipSpace()
+        if reader.peek() == b'}':
+            reader.take()
+        else:
+            while True:
+                key = _value(reader)
+                if not isinstance(key, str):
+                    raise BadBody('Request body is not a valid JSON object.')
+                reader.expect(b':')
+                reader.skipSpace()
+
+                if key in STREAMED_FIELDS:
+                    discard({key: body.pop(key, None)})
+                    if reader.peek() == b'"':
+                        reader.take()
+                        out = _Base64File(tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE))
+                        body[key] = out.out
+                        _streamString(reader, out)
+                        body[key] = out.finish()
+                    else:
+                        _value(reader)
+                        body[key] = None
+                else:
+                    body[key] = _value(reader)
+
+                reader.skipSpace()
+                c = reader.take()
+                if c == b'}':
+                    break
+                if c != b',':
+                    raise BadBody('Request body is not a valid JSON object.')
+
+        reader.skipSpace()
+        if not reader.atEnd():
+            raise BadBody('Request body is not a valid JSON object.')
+    except BadBody:
+        discard(body)
+        raise
+    except ValueError:
+        # A value that json couldn't make sense of, or a bad \u escape.
+        discard(body)
+        raise BadBody('Request body is not a valid JSON object.')
+    except:
+        discard(body)
+        raise
+
+    return body
+
+
+def _spool(request, limit):
+    """Reads the whole body into a temporary file, rewound, and returns it along with its size. Raises BodyTooLarge
+    once more than limit bytes have come in, whether or not the body was chunked."""
+    out = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    size = 0
+    try:
+        for chunk in _chunks(request):
+            size += len(chunk)
+            if size > limit:
+                raise BodyTooLarge('Request too large.')
+            out.write(chunk)
+    except:
+        out.close()
+        raise
+    out.seek(0)
+    return out, size
+
+
+def _parseMultipart(request, limit):
+    # bottle reads the body for request.forms without any limit on a chunked one, so it's read here first and bottle
+    # is handed that instead.
+    spooled, _ = _spool(request, limit)
+    request.environ['wsgi.input'] = spooled
+    request.environ['bottle.request.body'] = spooled
+
+    body = {}
+    if 'metadata' in request.forms:
+        try:
+            body = json.loads(request.forms['metadata'])
+        except ValueError:
+            raise BadBody('Metadata is not a valid JSON object.')
+        if not isinstance(body, dict):
+            raise BadBody('Metadata is not a valid JSON object.')
+        if any(field in body for field in STREAMED_FIELDS):
+            raise BadBody('The image has to be its own part, not in the metadata.')
+
+    for field in STREAMED_FIELDS:
+        upload = request.files.get(field)
+        if upload is not None:
+            body[field] = upload.file
+    return body
+
+
+def _parseRaw(request, limit):
+    body = {}
+    for field, header in METADATA_HEADERS.items():
+        value = request.get_header(header)
+        if value is not None:
+            body[field] = value
+
+    out, size = _spool(request, limit)
+    if size == 0:
+        out.close()
+        return body
+    body[STREAMED_FIELDS[0]] = out
+    return body
+
+
+def parseBody(request, limit):
+    """Parses a request's body as it's read, without ever holding all of it in memory, and returns its fields as a
+    dictionary. Each of the STREAMED_FIELDS is a file holding the image (or None if it was sent as base64 that wasn't
+    valid) instead. Call discard() on it afterwards.
+
+    A JSON body should be an object. A multipart/form-data body should have an "image" part and optionally a "metadata"
+    part. Anything else is taken to be the image itself, with its details in METADATA_HEADERS.
+
+    Raises BadBody if the body can't be parsed, or BodyTooLarge if it's bigger than limit bytes."""
+    contentType = request.content_type.lower().split(';')[0].strip()
+    if contentType == 'application/json':
+        return _parseJSON(request, limit)
+    if contentType == 'multipart/form-data':
+        return _parseMultipart(request, limit)
+    return _parseRaw(request, limit)
+
+
+def discard(body):
+    """Closes (and so deletes) any temporary files parseBody left in a body."""
+    for field in STREAMED_FIELDS:
+        f = body.get(field)
+        if f is not None:
+            f.close()